@@ -0,0 +1,105 @@
+import os
+import threading
+from contextlib import contextmanager
+from metrics import metrics
+
+# Runtime tuning of the batch size and of how many workers write at the same time, for concurrent_uploading
+# (AUTOTUNE=1). BATCH_SIZE and WORKER_COUNT are only the starting point then. Every AUTOTUNE_WINDOW written batches:
+# - more than AUTOTUNE_RETRY_RATE of them needed a retry (deadlocks): half the writers back off
+# - commits took longer than AUTOTUNE_TARGET_SECONDS: the batch size shrinks towards the target
+# - otherwise the batch size grows by BATCH_SIZE_STEP, and one more writer is let in as long as the rows/sec
+#   of the window didn't drop after the last one was added (if it did, that writer goes away again)
+# Workers keep parsing in parallel, only the writes wait for a slot.
+
+AUTOTUNE = os.getenv("AUTOTUNE", "0") == "1"
+AUTOTUNE_TARGET_SECONDS = float(os.getenv("AUTOTUNE_TARGET_SECONDS", 0.5))
+AUTOTUNE_RETRY_RATE = float(os.getenv("AUTOTUNE_RETRY_RATE", 0.05))
+AUTOTUNE_WINDOW = int(os.getenv("AUTOTUNE_WINDOW", 20))
+BATCH_SIZE_MIN = int(os.getenv("BATCH_SIZE_MIN", 10))
+BATCH_SIZE_MAX = int(os.getenv("BATCH_SIZE_MAX", 20000))
+BATCH_SIZE_STEP = int(os.getenv("BATCH_SIZE_STEP", 50))
+
+
+class AutoTuner:
+    def __init__(self, batch_size: int, max_workers: int, log, enabled: bool = AUTOTUNE):
+        self.log = log
+        self.enabled = enabled
+        self.batch_size = batch_size if not enabled else min(max(batch_size, BATCH_SIZE_MIN), BATCH_SIZE_MAX)
+        self.max_workers = max(1, max_workers)
+        # starts in the middle, so there's room to go both ways
+        self.workers = max(1, self.max_workers // 2) if enabled else self.max_workers
+        self._active = 0
+        self._slots = threading.Condition()
+        self._lock = threading.Lock()
+        self._window = [0, 0, 0.0, 0]  # batches, rows, seconds, batches that needed a retry
+        self._last_rate = 0.0
+        self._added_worker = False
+        self.adjustments = 0
+
+    @contextmanager
+    def slot(self):
+        """Holds one of the `workers` write slots while writing a batch."""
+        if not self.enabled:
+            yield
+            return
+        with self._slots:
+            while self._active >= self.workers:
+                self._slots.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._slots:
+                self._active -= 1
+                self._slots.notify()
+
+    def record(self, rows: int, seconds: float, retries: int):
+        """One written batch: its rows, how long it took including the retries and how many retries it needed."""
+        if not self.enabled:
+            return
+        with self._lock:
+            window = self._window
+            window[0] += 1
+            window[1] += rows
+            window[2] += seconds
+            window[3] += retries > 0
+            if window[0] < AUTOTUNE_WINDOW:
+                return
+            self._window = [0, 0, 0.0, 0]
+            self._adjust(*window)
+
+    def _adjust(self, batches: int, rows: int, seconds: float, retried: int):
+        retry_rate = retried / batches
+        latency = seconds / batches
+        # rows per second of all writers together, every one of them writes about the same
+        rate = rows / seconds * self.workers if seconds else 0.0
+        batch_size, workers = self.batch_size, self.workers
+        if retry_rate > AUTOTUNE_RETRY_RATE:
+            workers = max(1, workers // 2)
+            self._added_worker = False
+        elif latency > AUTOTUNE_TARGET_SECONDS:
+            batch_size = max(BATCH_SIZE_MIN, batch_size // 2, int(batch_size * AUTOTUNE_TARGET_SECONDS / latency))
+            self._added_worker = False
+        else:
+            batch_size = min(BATCH_SIZE_MAX, batch_size + BATCH_SIZE_STEP)
+            if self._added_worker and rate < self._last_rate:
+                workers = max(1, workers - 1)
+                self._added_worker = False
+            elif workers < self.max_workers:
+                workers += 1
+                self._added_worker = True
+        self._last_rate = rate
+        metrics.set("autotune_batch_size", batch_size)
+        metrics.set("autotune_workers", workers)
+        if (batch_size, workers) != (self.batch_size, self.workers):
+            self.adjustments += 1
+            self.log.info(f"Autotune: batch size {self.batch_size} -> {batch_size}, workers {self.workers} -> {workers}"
+                          f" ({latency:.3f}s per batch, {rate:.0f} rows/sec, {retry_rate:.0%} retried)", False)
+        self.batch_size = batch_size
+        with self._slots:
+            self.workers = workers
+            self._slots.notify_all()
+
+    def report(self) -> str:
+        return (f"batch size {self.batch_size}, {self.workers}/{self.max_workers} workers, "
+                f"{self.adjustments} adjustments")
@@ -0,0 +1,43 @@
+import sys
+from time import perf_counter
+from jsonl_reader import list_jsonl_files
+from tweet_decoder import validate_line, fast_decode_line
+
+# usage: python -m benchmarks.bench_decoder [file.jsonl] [max_lines]
+# decodes the same lines with both decoders and prints tweets/sec side by side
+
+
+def read_lines(path: str, max_lines: int) -> list[bytes]:
+    lines = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            lines.append(line)
+            if len(lines) >= max_lines:
+                break
+    return lines
+
+
+def bench(decode, lines: list[bytes]) -> float:
+    time_before = perf_counter()
+    for line in lines:
+        decode(line)
+    return len(lines) / (perf_counter() - time_before)
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else list_jsonl_files()[0]
+    max_lines = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    lines = read_lines(path, max_lines)
+
+    # both paths have to produce the same models, otherwise the numbers mean nothing
+    mismatches = sum(1 for line in lines
+                     if validate_line(line).model_dump() != fast_decode_line(line).model_dump(exclude={'extended_entities'}))
+
+    validated = bench(validate_line, lines)
+    fast = bench(fast_decode_line, lines)
+    print(f"{'decoder':<10} {'tweets/sec':>12}")
+    print(f"{'pydantic':<10} {validated:>12.0f}")
+    print(f"{'fast':<10} {fast:>12.0f}")
+    print(f"speedup {fast / validated:.2f}x on {len(lines)} tweets, {mismatches} mismatching tweets")
@@ -0,0 +1,43 @@
+import os
+import sys
+from time import perf_counter
+from jsonl_reader import list_jsonl_files, iter_records
+from tweet_decoder import decode_line
+
+# usage: python -m benchmarks.bench_reader [file.jsonl] [repeats]
+# reads the same file with the old text mode loop and the memory mapped reader and prints MB/s, once only reading
+# and once with every line decoded
+
+
+def text_lines(path: str):
+    # the loop process_file used before the mmap reader
+    with open(path, 'r') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            yield line
+
+
+def bench(read, path: str, decode=None, repeats: int = 3) -> tuple[float, int]:
+    best = float("inf")
+    count = 0
+    for _ in range(repeats):
+        time_before = perf_counter()
+        count = 0
+        for line in read(path):
+            if decode:
+                decode(line)
+            count += 1
+        best = min(best, perf_counter() - time_before)
+    return os.path.getsize(path) / 1024 / 1024 / best, count
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else list_jsonl_files()[0]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    print(f"{'reader':<8} {'read MB/s':>12} {'decode MB/s':>12}")
+    for name, read in (("text", text_lines), ("mmap", iter_records)):
+        read_only, count = bench(read, path, repeats=repeats)
+        decoded, _ = bench(read, path, decode_line, repeats=1)
+        print(f"{name:<8} {read_only:>12.1f} {decoded:>12.1f}  ({count} lines)")
@@ -0,0 +1,277 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+from benchmarks.synthetic import SyntheticConfig, generate, add_arguments, config_from_args
+from compact_sets import DEDUP_BACKEND, IntSet, PairSet, DiskIntSet, DiskPairSet, close_registries
+from count_keys import COUNTED, count_tweet
+from copy_loader import COPY_TABLES, COPY_FORMAT, batch_rows, to_copy_buffer, stage_types, stage_name, copy_batches
+from csv_dedup import CsvDedup, new_candidates, collect_tweet
+from jsonl_reader import iter_records
+from pgcopy import encode_rows
+from schema import *
+from table_output import OUTPUT_FORMAT, TABLES, ShardWriter
+from tweet_batches import SeenTweets, new_batches, add_tweet
+from tweet_decoder import DECODER, decode_line
+
+# usage: python -m benchmarks.bench_stages [--input file.jsonl] [--report report.json] [--db] [--repeat 3] [...]
+#        python -m benchmarks.bench_stages --compare old.json new.json
+# times every stage of load_into_csv, concurrent_uploading and counting on its own (read, decode, validate, dedup,
+# serialize and optionally the db write) on the same input, synthetic tweets (see benchmarks.synthetic) unless
+# --input is given. The dedup stages run the loaders' own code (csv_dedup, tweet_batches, count_keys). The json report
+# holds the configuration next to the numbers, so two runs can be diffed.
+
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 100))
+
+
+def timed(stage, repeat: int = 1):
+    """Runs `stage` `repeat` times, returns (result of the last run, best time)."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        time_before = perf_counter()
+        result = stage()
+        best = min(best, perf_counter() - time_before)
+    return result, best
+
+
+def stage_result(seconds: float, items: int, size: int | None = None) -> dict:
+    result = {"seconds": round(seconds, 6), "items": items,
+              "items_per_sec": round(items / seconds, 1) if seconds else None}
+    if size is not None:
+        result["mb_per_sec"] = round(size / 1024 / 1024 / seconds, 2) if seconds else None
+    return result
+
+
+def walk(tweets: list[Tweet]):
+    """Every tweet with its nested retweets and quotes, like the loaders visit them."""
+    stack = list(reversed(tweets))
+    while stack:
+        tweet = stack.pop()
+        yield tweet
+        if tweet.retweeted_status:
+            stack.append(tweet.retweeted_status)
+        if tweet.quoted_status:
+            stack.append(tweet.quoted_status)
+
+
+def registries(directory: str, names: list[str], pairs: set[str]) -> dict:
+    """Fresh registries of the configured DEDUP_BACKEND, disk ones in `directory`."""
+    result = {}
+    for name in names:
+        if DEDUP_BACKEND == "disk":
+            result[name] = DiskPairSet(os.path.join(directory, f"{name}.pairs")) if name in pairs \
+                else DiskIntSet(os.path.join(directory, f"{name}.ids"))
+        elif DEDUP_BACKEND == "compact":
+            result[name] = PairSet() if name in pairs else IntSet()
+        else:
+            result[name] = set()
+    return result
+
+
+def csv_dedup(tweets: list[Tweet], directory: str) -> dict[str, list]:
+    """load_into_csv: collect_tweet, reconciled every BATCH_SIZE lines, returns the rows per output table."""
+    seen = registries(directory, TABLES, {"tweet_hashtag", "urls", "media", "user_mentions"})
+    dedup = CsvDedup(seen)
+    candidates = new_candidates()
+    rows = {table: [] for table in TABLES}
+    for start in range(0, len(tweets), BATCH_SIZE):
+        for tweet in tweets[start:start + BATCH_SIZE]:
+            collect_tweet(candidates, tweet)
+        dedup.reconcile(candidates, rows)
+    close_registries(seen.values())
+    return rows
+
+
+def csv_serialize(rows: dict[str, list], directory: str) -> int:
+    """load_into_csv: writes the rows of OUTPUT_FORMAT through a ShardWriter, returns the bytes."""
+    writer = ShardWriter("bench", TABLES, directory)
+    for table, table_rows in rows.items():
+        writer.rows[table].extend(table_rows)
+        writer.flush_if_full()
+    writer.close()
+    return sum(os.path.getsize(path) for path in writer.paths.values() if os.path.exists(path))
+
+
+def upload_batches(tweets: list[Tweet]) -> list[dict[str, list]]:
+    """concurrent_uploading: add_tweet into the per table batches, BATCH_SIZE lines each."""
+    seen = SeenTweets(set())
+    result = []
+    for start in range(0, len(tweets), BATCH_SIZE):
+        batches = new_batches()
+        for tweet in tweets[start:start + BATCH_SIZE]:
+            add_tweet(batches, tweet, seen)
+        seen.commit([tweet.id for tweet in batches["tweets"]])
+        result.append(batches)
+    return result
+
+
+def upload_serialize(all_batches: list[dict[str, list]]) -> int:
+    """concurrent_uploading: what copy_batches sends for COPY_FORMAT, returns the bytes."""
+    size = 0
+    for batches in all_batches:
+        for table in COPY_TABLES:
+            rows = batch_rows(table, batches[table.name])
+            if COPY_FORMAT == "binary":
+                size += len(encode_rows(stage_types(table), rows))
+            else:
+                size += len(to_copy_buffer(rows).getvalue())
+    return size
+
+
+def upload_db_write(all_batches: list[dict[str, list]]):
+    """concurrent_uploading: copy_batches for every batch in one transaction, rolled back at the end. Every batch
+    goes into a savepoint of its own and the stage tables are truncated after it, like the commit of a batch empties
+    them (ON COMMIT DELETE ROWS), otherwise every merge would go through the rows of all earlier batches again."""
+    from utils import get_connection
+    stage_tables = ", ".join(stage_name(table) for table in COPY_TABLES)
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            for batches in all_batches:
+                cur.execute("SAVEPOINT bench_batch")
+                copy_batches(cur, batches)
+                cur.execute("RELEASE SAVEPOINT bench_batch")
+                cur.execute(f"TRUNCATE {stage_tables}")
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def count_dedup(tweets: list[Tweet], directory: str) -> dict[str, int]:
+    """counting: count_tweet into the exact sets."""
+    sets = registries(directory, [f"counting_{name}" for name in COUNTED],
+                      {"counting_urls", "counting_media", "counting_user_mentions"})
+    s = {name: sets[f"counting_{name}"] for name in COUNTED}
+
+    def add(name: str, keys):
+        registry = s[name]
+        for key in keys:
+            registry.add(key)
+
+    for tweet in tweets:
+        count_tweet(tweet, add)
+    counts = {name: len(registry) for name, registry in s.items()}
+    close_registries(sets.values())
+    return counts
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(path: str, repeat: int, db: bool, config: SyntheticConfig | None) -> dict:
+    size = os.path.getsize(path)
+    lines, read_seconds = timed(lambda: list(iter_records(path)), repeat)
+    dicts, decode_seconds = timed(lambda: [json.loads(strip_nul_bytes(line)) for line in lines], repeat)
+
+    def validate():
+        tweets = []
+        for tweet_json in dicts:
+            if 'extended_entities' in tweet_json:
+                tweet_json = dict(tweet_json, entities=merge_entities(tweet_json.get('entities', {}),
+                                                                      tweet_json['extended_entities']))
+            tweets.append(Tweet.model_validate(tweet_json, context=SANITIZED))
+        return tweets
+
+    tweets, validate_seconds = timed(validate, repeat)
+    _, decode_line_seconds = timed(lambda: [decode_line(line) for line in lines], repeat)
+    entity_count = sum(1 for _ in walk(tweets))
+
+    shared = {
+        "read": stage_result(read_seconds, len(lines), size),
+        "decode": stage_result(decode_seconds, len(lines), size),
+        "validate": stage_result(validate_seconds, len(lines)),
+        "decode_line": stage_result(decode_line_seconds, len(lines), size),  # decode + validate as DECODER does it
+    }
+    loaders = {}
+    with tempfile.TemporaryDirectory() as directory:
+        rows, dedup_seconds = timed(lambda: csv_dedup(tweets, directory), 1)
+        written, serialize_seconds = timed(lambda: csv_serialize(rows, directory), 1)
+        loaders["load_into_csv"] = dict(shared, dedup=stage_result(dedup_seconds, entity_count),
+                                        serialize=stage_result(serialize_seconds,
+                                                               sum(len(table_rows) for table_rows in rows.values()),
+                                                               written))
+
+        all_batches, batch_seconds = timed(lambda: upload_batches(tweets), repeat)
+        sent, upload_serialize_seconds = timed(lambda: upload_serialize(all_batches), repeat)
+        row_count = sum(len(batch) for batches in all_batches for batch in batches.values())
+        loaders["concurrent_uploading"] = dict(shared, dedup=stage_result(batch_seconds, entity_count),
+                                               serialize=stage_result(upload_serialize_seconds, row_count, sent))
+        if db:
+            try:
+                _, db_seconds = timed(lambda: upload_db_write(all_batches), 1)
+                loaders["concurrent_uploading"]["db_write"] = stage_result(db_seconds, row_count)
+            except Exception as e:
+                loaders["concurrent_uploading"]["db_write"] = {"error": str(e)}
+
+        counts, count_seconds = timed(lambda: count_dedup(tweets, directory), 1)
+        loaders["counting"] = dict(shared, dedup=stage_result(count_seconds, entity_count))
+
+    for stages in loaders.values():
+        stages["total_seconds"] = round(sum(stage.get("seconds", 0) for name, stage in stages.items()
+                                            if name != "decode_line"), 6)
+    return {
+        "meta": {"input": path, "bytes": size, "lines": len(lines), "synthetic": config._asdict() if config else None,
+                 "repeat": repeat, "decoder": DECODER, "dedup_backend": DEDUP_BACKEND, "output_format": OUTPUT_FORMAT,
+                 "copy_format": COPY_FORMAT, "batch_size": BATCH_SIZE, "git": git_revision(),
+                 "python": platform.python_version(), "platform": platform.platform()},
+        "unique_counts": counts,
+        "loaders": loaders,
+    }
+
+
+def compare(old: dict, new: dict) -> str:
+    """Per stage seconds of two reports, new/old > 1 means slower."""
+    lines = [f"{'loader':<22} {'stage':<12} {'old s':>10} {'new s':>10} {'new/old':>8}"]
+    for loader, stages in new["loaders"].items():
+        for stage, result in stages.items():
+            old_result = old["loaders"].get(loader, {}).get(stage)
+            if stage == "total_seconds":
+                old_seconds, new_seconds = old_result, result
+            elif isinstance(old_result, dict) and "seconds" in old_result and "seconds" in result:
+                old_seconds, new_seconds = old_result["seconds"], result["seconds"]
+            else:
+                continue
+            ratio = new_seconds / old_seconds if old_seconds else float("nan")
+            lines.append(f"{loader:<22} {stage:<12} {old_seconds:>10.4f} {new_seconds:>10.4f} {ratio:>8.2f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--compare":
+        with open(sys.argv[2]) as old_file, open(sys.argv[3]) as new_file:
+            print(compare(json.load(old_file), json.load(new_file)))
+        sys.exit()
+
+    parser = argparse.ArgumentParser(description="times every stage of the loaders")
+    parser.add_argument("--input", help="jsonl file, synthetic tweets are generated if missing")
+    parser.add_argument("--report", default="bench_report.json")
+    parser.add_argument("--repeat", type=int, default=3, help="best of n for the repeatable stages")
+    parser.add_argument("--db", action="store_true", help="also time the COPY into the database (rolled back)")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as input_dir:
+        config = None
+        path = args.input
+        if path is None:
+            config = config_from_args(args)
+            path = os.path.join(input_dir, "synthetic.jsonl")
+            generate(path, config)
+        report = run(path, args.repeat, args.db, config)
+
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    for loader, stages in report["loaders"].items():
+        print(f"{loader}: " + ", ".join(f"{name} {stage['seconds']:.3f}s" for name, stage in stages.items()
+                                        if isinstance(stage, dict) and "seconds" in stage))
+    print(f"report written to {args.report}")
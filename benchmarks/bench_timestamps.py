@@ -0,0 +1,55 @@
+import random
+from datetime import datetime
+from time import perf_counter
+from schema import to_iso_format
+
+# usage: python -m benchmarks.bench_timestamps [count]
+# compares the strptime based conversion with the fixed layout parser, uncached and cached, for twitter and iso input
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+
+def strptime_to_iso_format(date_str: str) -> str:
+    # to_iso_format as it was before the fixed layout parser
+    try:
+        datetime.fromisoformat(date_str)
+        return date_str
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(date_str, '%a %b %d %H:%M:%S %z %Y').isoformat()
+    except ValueError:
+        return date_str
+
+
+def make_dates(count: int, distinct: int, seed: int = 42) -> tuple[list[str], list[str]]:
+    """Returns (twitter, iso) inputs, `distinct` different values repeated like users' created_at are."""
+    rnd = random.Random(seed)
+    pool = [f"{rnd.choice(WEEKDAYS)} {rnd.choice(MONTHS)} {rnd.randint(1, 28):02d} {rnd.randint(0, 23):02d}:"
+            f"{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d} +0000 {rnd.randint(2006, 2023)}" for _ in range(distinct)]
+    twitter = [rnd.choice(pool) for _ in range(count)]
+    iso = [strptime_to_iso_format(date_str) for date_str in twitter]
+    return twitter, iso
+
+
+def bench(convert, dates: list[str]) -> float:
+    time_before = perf_counter()
+    for date_str in dates:
+        convert(date_str)
+    return len(dates) / (perf_counter() - time_before)
+
+
+if __name__ == "__main__":
+    import sys
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    twitter, iso = make_dates(count, distinct=count // 10)
+    assert all(to_iso_format(d) == strptime_to_iso_format(d) for d in twitter + iso)
+
+    uncached = to_iso_format.__wrapped__
+    print(f"{'input':<8} {'strptime':>12} {'fixed':>12} {'fixed+cache':>12}  (conversions/sec)")
+    for name, dates in (("twitter", twitter), ("iso", iso)):
+        to_iso_format.cache_clear()
+        results = [bench(strptime_to_iso_format, dates), bench(uncached, dates), bench(to_iso_format, dates)]
+        print(f"{name:<8} " + " ".join(f"{r:>12.0f}" for r in results))
+    print(to_iso_format.cache_info())
@@ -0,0 +1,162 @@
+import argparse
+import json
+import random
+from typing import NamedTuple
+
+# usage: python -m benchmarks.synthetic out.jsonl [--tweets 10000] [--seed 42] [...]
+# writes deterministic tweets in the shape schema.Tweet reads (user, place, entities, extended_entities, nested
+# retweets and quotes), the same arguments always give the same file byte for byte
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+WORDS = ['covid', 'vaccine', 'ukraine', 'news', 'today', 'breaking', 'world', 'people', 'time', 'love', 'život',
+         'trh', 'ĺúbim', 'data', 'postgres', 'tweet', 'thread', 'video', 'photo', 'update']
+
+
+class SyntheticConfig(NamedTuple):
+    tweets: int = 10000  # top level lines
+    seed: int = 42
+    users: int = 2000
+    places: int = 100
+    hashtags: int = 500  # distinct tags
+    hashtag_fanout: int = 4  # at most this many hashtags per tweet
+    mention_fanout: int = 3  # at most this many mentions per tweet
+    url_fanout: int = 2
+    media_ratio: float = 0.2  # tweets with extended_entities media
+    place_ratio: float = 0.1
+    retweet_ratio: float = 0.3  # top level tweets that are retweets of another tweet
+    quote_ratio: float = 0.1
+    duplicate_ratio: float = 0.05  # lines repeating an earlier top level tweet verbatim
+    nul_ratio: float = 0.01  # tweets with NUL bytes in their text
+    blank_every: int = 500  # an empty line after every n tweets, 0 for none
+
+
+def _date(rnd: random.Random) -> str:
+    return (f"{rnd.choice(WEEKDAYS)} {rnd.choice(MONTHS)} {rnd.randint(1, 28):02d} {rnd.randint(0, 23):02d}:"
+            f"{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d} +0000 {rnd.randint(2019, 2023)}")
+
+
+def _text(rnd: random.Random, words: int) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(words))
+
+
+def _user(rnd: random.Random, user_id: int) -> dict:
+    return {"id": user_id, "id_str": str(user_id), "name": f"User {user_id}", "screen_name": f"user_{user_id}",
+            "location": rnd.choice(["Bratislava", "Kyiv", "", None, "Somewhere, \"quoted\""]),
+            "url": f"https://example.com/{user_id}" if user_id % 3 == 0 else None,
+            "description": _text(rnd, rnd.randint(0, 12)), "protected": user_id % 50 == 0,
+            "verified": user_id % 20 == 0, "followers_count": rnd.randint(0, 100000),
+            "friends_count": rnd.randint(0, 5000), "statuses_count": rnd.randint(0, 50000),
+            "created_at": _date(rnd)}
+
+
+def _place(place_id: int) -> dict:
+    return {"id": f"{place_id:016x}", "place_type": "city", "full_name": f"City {place_id}, Country",
+            "country_code": "SK" if place_id % 2 else "UA", "country": "Slovakia" if place_id % 2 else "Ukraine"}
+
+
+def _media(rnd: random.Random, tweet_id: int, index: int) -> dict:
+    media_id = tweet_id + 1 + index
+    return {"id": media_id, "id_str": str(media_id), "type": rnd.choice(["photo", "video", "animated_gif"]),
+            "media_url": f"http://pbs.example.com/{media_id}.jpg",
+            "media_url_https": f"https://pbs.example.com/{media_id}.jpg", "display_url": f"pic.example.com/{media_id}",
+            "expanded_url": f"https://example.com/status/{tweet_id}/photo/1"}
+
+
+class _Generator:
+    def __init__(self, config: SyntheticConfig):
+        self.config = config
+        self.rnd = random.Random(config.seed)
+        self.next_id = 12 * 10 ** 17
+        self.users: dict[int, dict] = {}
+
+    def user(self, user_id: int) -> dict:
+        # every user is generated once and then always the same, like a real user within one dump. Its own random
+        # generator keeps it independent of when it shows up first.
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = _user(random.Random(f"{self.config.seed}-{user_id}"), user_id)
+        return user
+
+    def tweet(self, nested: bool = False) -> dict:
+        c, rnd = self.config, self.rnd
+        self.next_id += rnd.randint(1, 1000)
+        tweet_id = self.next_id
+        text = _text(rnd, rnd.randint(3, 30))
+        if rnd.random() < c.nul_ratio:
+            text += "\x00"
+        tags = [f"tag{rnd.randint(1, c.hashtags)}" for _ in range(rnd.randint(0, c.hashtag_fanout))]
+        mentions = [rnd.randint(1, c.users * 2) for _ in range(rnd.randint(0, c.mention_fanout))]
+        entities = {
+            "hashtags": [{"text": tag, "indices": [0, len(tag) + 1]} for tag in tags],
+            "user_mentions": [{"id": user_id, "id_str": str(user_id), "screen_name": f"user_{user_id}",
+                               "name": f"User {user_id}", "indices": [0, 1]} for user_id in mentions],
+            "urls": [{"url": f"https://t.co/{tweet_id % 100000}{i}",
+                      "expanded_url": f"https://example.com/{tweet_id}/{i}",
+                      "display_url": f"example.com/{tweet_id}/{i}",
+                      "unwound_url": {"url": f"https://example.com/{tweet_id}/{i}", "status": 200, "title": "t",
+                                      "description": "d"} if i % 2 else None}
+                     for i in range(rnd.randint(0, c.url_fanout))],
+        }
+        tweet = {"created_at": _date(rnd), "id": tweet_id, "id_str": str(tweet_id),
+                 "full_text": text + "".join(f" #{tag}" for tag in tags),
+                 "truncated": False, "display_text_range": [0, len(text)],
+                 "entities": entities, "source": "<a href=\"https://example.com\">Example</a>",
+                 "in_reply_to_status_id": tweet_id - 1 if rnd.random() < 0.1 else None,
+                 "user": self.user(rnd.randint(1, c.users)),
+                 "place": _place(rnd.randint(1, c.places)) if rnd.random() < c.place_ratio else None,
+                 "retweet_count": rnd.randint(0, 1000), "favorite_count": rnd.randint(0, 5000),
+                 "possibly_sensitive": rnd.random() < 0.05, "lang": rnd.choice(["en", "sk", "uk", "und"])}
+        if rnd.random() < c.media_ratio:
+            media = [_media(rnd, tweet_id, i) for i in range(rnd.randint(1, 4))]
+            # entities only ever carry the first one, extended_entities all of them (merge_entities dedups by id)
+            entities["media"] = media[:1]
+            tweet["extended_entities"] = {"media": media}
+        if not nested:
+            if rnd.random() < c.quote_ratio:
+                tweet["quoted_status"] = self.tweet(nested=True)
+                tweet["quoted_status_id"] = tweet["quoted_status"]["id"]
+            if rnd.random() < c.retweet_ratio:
+                tweet["retweeted_status"] = self.tweet(nested=True)
+        return tweet
+
+
+def generate_lines(config: SyntheticConfig):
+    generator = _Generator(config)
+    written: list[str] = []
+    for i in range(config.tweets):
+        if written and generator.rnd.random() < config.duplicate_ratio:
+            line = generator.rnd.choice(written)
+        else:
+            line = json.dumps(generator.tweet(), ensure_ascii=False)
+            if len(written) < 10000:  # duplicates come from the first tweets, keeps memory bounded
+                written.append(line)
+        yield line + "\n"
+        if config.blank_every and (i + 1) % config.blank_every == 0:
+            yield "\n"
+
+
+def generate(path: str, config: SyntheticConfig = SyntheticConfig()) -> int:
+    """Writes the tweets of `config` into `path`, returns the size in bytes."""
+    with open(path, 'w', encoding='utf-8', newline='\n') as f:
+        for line in generate_lines(config):
+            f.write(line)
+        return f.tell()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    for name, default in SyntheticConfig._field_defaults.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+
+
+def config_from_args(args: argparse.Namespace) -> SyntheticConfig:
+    return SyntheticConfig(**{name: getattr(args, name) for name in SyntheticConfig._fields})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="writes deterministic synthetic tweets")
+    parser.add_argument("path")
+    add_arguments(parser)
+    args = parser.parse_args()
+    size = generate(args.path, config_from_args(args))
+    print(f"wrote {args.tweets} tweets, {size / 1024 / 1024:.1f} MB into {args.path}")
@@ -0,0 +1,184 @@
+import os
+import re
+import concurrent.futures as cf
+from collections import defaultdict
+from time import perf_counter
+from typing import NamedTuple
+from utils import get_connection
+
+# Bulk load lifecycle around sql_scripts/schema.sql. Every loaded row normally pays for the secondary indexes and the
+# foreign key checks, so for a bulk load:
+# 1. create_bare_tables: the tables of schema.sql with their primary keys and UNIQUE columns only (the loaders' ON
+#    CONFLICT clauses need those), no REFERENCES and no CREATE INDEX
+# 2. load with any of the loaders
+# 3. build_indexes: the CREATE INDEX statements of schema.sql, several at once on their own connections
+# 4. add_foreign_keys: the REFERENCES of schema.sql as NOT VALID constraints, which only checks rows written from now on
+# 5. validate_foreign_keys: VALIDATE CONSTRAINT, tables in parallel (validations of one table queue behind each other
+#    anyway), a constraint that fails stays NOT VALID and is reported
+# Everything is derived from schema.sql, so it stays the only place the schema is written down.
+
+SCHEMA_PATH = 'sql_scripts/schema.sql'
+BULK_SCHEMA_WORKERS = int(os.getenv("BULK_SCHEMA_WORKERS", 4))
+# e.g. 1GB, index builds and validations sort a lot more in memory than the default 64MB
+MAINTENANCE_WORK_MEM = os.getenv("MAINTENANCE_WORK_MEM", "")
+
+_REFERENCES = re.compile(r'\s+REFERENCES\s+(\w+)\s*\((\w+)\)((?:\s+ON\s+(?:DELETE|UPDATE)\s+'
+                         r'(?:CASCADE|SET\s+NULL|SET\s+DEFAULT|RESTRICT|NO\s+ACTION))*)', re.IGNORECASE)
+_CREATE_TABLE = re.compile(r'CREATE\s+TABLE\s+(\w+)', re.IGNORECASE)
+_CREATE_INDEX = re.compile(r'CREATE\s+(UNIQUE\s+)?INDEX\s+(\w+)', re.IGNORECASE)
+
+
+class ForeignKey(NamedTuple):
+    table: str
+    column: str
+    target: str
+    target_column: str
+    actions: str  # e.g. " ON DELETE CASCADE"
+
+    @property
+    def name(self) -> str:
+        # the name postgres gives the inline REFERENCES, same constraints as a plain build_schema
+        return f"{self.table}_{self.column}_fkey"
+
+    def add_statement(self) -> str:
+        return (f"ALTER TABLE {self.table} ADD CONSTRAINT {self.name} FOREIGN KEY ({self.column}) "
+                f"REFERENCES {self.target}({self.target_column}){self.actions} NOT VALID")
+
+
+class BulkSchema(NamedTuple):
+    tables: list[str]  # CREATE TABLE statements without REFERENCES
+    indexes: list[tuple[str, str]]  # (name, CREATE INDEX IF NOT EXISTS statement)
+    foreign_keys: list[ForeignKey]
+
+
+def split_schema(path: str = SCHEMA_PATH) -> BulkSchema:
+    with open(path, 'r') as f:
+        sql = "\n".join(line.split('--', 1)[0].rstrip() for line in f.read().splitlines())
+    tables, indexes, foreign_keys = [], [], []
+    for statement in (part.strip() for part in sql.split(';')):
+        table = _CREATE_TABLE.match(statement)
+        index = _CREATE_INDEX.match(statement)
+        if table:
+            for line in statement.splitlines():
+                reference = _REFERENCES.search(line)
+                if reference:
+                    actions = " ".join(reference.group(3).split())
+                    foreign_keys.append(ForeignKey(table.group(1), line.split()[0], reference.group(1),
+                                                   reference.group(2), f" {actions}" if actions else ""))
+            tables.append(_REFERENCES.sub('', statement))
+        elif index:
+            indexes.append((index.group(2), _CREATE_INDEX.sub(
+                lambda m: f"CREATE {m.group(1) or ''}INDEX IF NOT EXISTS {m.group(2)}", statement, count=1)))
+        elif statement:
+            raise ValueError(f"Don't know when to run this part of {path}: {statement[:60]}")
+    return BulkSchema(tables, indexes, foreign_keys)
+
+
+def _connect():
+    connection = get_connection()
+    connection.autocommit = True
+    if MAINTENANCE_WORK_MEM:
+        with connection.cursor() as cursor:
+            cursor.execute("SET maintenance_work_mem = %s", (MAINTENANCE_WORK_MEM,))
+    return connection
+
+
+def _run_all(jobs: dict[str, list[str]]) -> tuple[dict[str, float], dict[str, str]]:
+    """Runs every job's statements in order on a connection of its own, up to BULK_SCHEMA_WORKERS jobs at once.
+    Returns the seconds and the errors per job."""
+    def run(statements: list[str]) -> float:
+        time_before = perf_counter()
+        connection = _connect()
+        try:
+            with connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+        finally:
+            connection.close()
+        return perf_counter() - time_before
+
+    seconds, errors = {}, {}
+    with cf.ThreadPoolExecutor(max_workers=max(1, BULK_SCHEMA_WORKERS)) as executor:
+        futures = {executor.submit(run, statements): name for name, statements in jobs.items()}
+        for future in cf.as_completed(futures):
+            try:
+                seconds[futures[future]] = future.result()
+            except Exception as e:
+                errors[futures[future]] = str(e).strip()
+    return seconds, errors
+
+
+def create_bare_tables(schema: BulkSchema, connection=None):
+    connection_passed = connection is not None
+    if not connection_passed:
+        connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(";\n".join(schema.tables))
+        connection.commit()
+    finally:
+        if not connection_passed:
+            connection.close()
+
+
+def build_indexes(schema: BulkSchema) -> tuple[dict[str, float], dict[str, str]]:
+    # CREATE INDEX only takes a SHARE lock, builds on the same table don't wait for each other
+    return _run_all({name: [statement] for name, statement in schema.indexes})
+
+
+def add_foreign_keys(schema: BulkSchema, connection=None) -> list[str]:
+    """Adds the missing foreign keys as NOT VALID, returns their names."""
+    connection_passed = connection is not None
+    if not connection_passed:
+        connection = get_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT conname FROM pg_constraint WHERE contype = 'f'")
+            existing = {row[0] for row in cursor.fetchall()}
+            added = [foreign_key for foreign_key in schema.foreign_keys if foreign_key.name not in existing]
+            # no table is scanned, one short transaction for all of them
+            for foreign_key in added:
+                cursor.execute(foreign_key.add_statement())
+        connection.commit()
+    finally:
+        if not connection_passed:
+            connection.close()
+    return [foreign_key.name for foreign_key in added]
+
+
+def validate_foreign_keys(schema: BulkSchema) -> tuple[dict[str, float], dict[str, str]]:
+    """Per table: the seconds its validations took and the error of the one that failed."""
+    by_table = defaultdict(list)
+    for foreign_key in schema.foreign_keys:
+        by_table[foreign_key.table].append(f"ALTER TABLE {foreign_key.table} VALIDATE CONSTRAINT {foreign_key.name}")
+    return _run_all(by_table)
+
+
+def finish_bulk_load(schema: BulkSchema | None = None) -> dict[str, float]:
+    """Steps 3-5 after the data is loaded, prints what every phase took and returns it."""
+    schema = schema or split_schema()
+    phases = {}
+
+    time_before = perf_counter()
+    index_seconds, index_errors = build_indexes(schema)
+    phases["indexes"] = perf_counter() - time_before
+    for name, seconds in sorted(index_seconds.items(), key=lambda item: -item[1]):
+        print(f"  index {name}: {seconds:.2f}s")
+    for name, error in index_errors.items():
+        print(f"  index {name} failed: {error}")
+
+    time_before = perf_counter()
+    added = add_foreign_keys(schema)
+    phases["foreign keys (NOT VALID)"] = perf_counter() - time_before
+    print(f"  added {len(added)} foreign keys as NOT VALID")
+
+    time_before = perf_counter()
+    validate_seconds, validate_errors = validate_foreign_keys(schema)
+    phases["validate"] = perf_counter() - time_before
+    for table, seconds in sorted(validate_seconds.items(), key=lambda item: -item[1]):
+        print(f"  validated foreign keys of {table}: {seconds:.2f}s")
+    for table, error in validate_errors.items():
+        print(f"  foreign keys of {table} not validated, they stay NOT VALID: {error}")
+
+    print("Bulk load phases: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in phases.items()))
+    return phases
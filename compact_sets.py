@@ -0,0 +1,410 @@
+import mmap
+import os
+import struct
+from array import array
+from hashlib import blake2b
+
+# Memory compact replacements for the dedup sets of load_into_csv, sharded_export and counting. A python set of ints
+# costs ~100 bytes per entry (the boxed int plus the hash table slot), a set of tuples even more. These are open
+# addressing hash tables (linear probing) over flat int64 arrays, 8 bytes per slot for single keys and 16 for pairs,
+# so ~12 and ~24 bytes per entry at the usual fill.
+#
+# Strings are stored as a 64 bit blake2b digest. Two different strings with the same digest would count as one, at
+# 64 bits that's ~1 in 10^8 even with a billion distinct strings, fine for dedup of urls and place ids.
+#
+# DEDUP_BACKEND=compact switches the registries to these, "python" (the default) keeps the builtin sets.
+# DEDUP_BACKEND=disk keeps the same tables in memory mapped files under DEDUP_DIR (see DiskIntSet), they don't count
+# against the process heap and DEDUP_RAM_MB caps how much of them stays resident. concurrent_uploading keeps its
+# seen_ids file across runs (RESUME=0 empties it), only ids of committed batches go in, so a later run skips them
+# without asking the database. The csv exports (load_into_csv, sharded_export) deliberately don't reuse theirs: every
+# export writes complete csv files, so its registries clear() at the start and a resumed export rebuilds them from
+# what its finished chunks recorded. counting keeps its own in a temporary directory.
+
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "python")
+DEDUP_DIR = os.getenv("DEDUP_DIR", "dedup")
+# resident pages of all open disk registries together, 0 leaves it to the kernel
+DEDUP_RAM_MB = float(os.getenv("DEDUP_RAM_MB", 0))
+
+EMPTY = -2 ** 63  # marks a free slot, a key with this value is remembered in a flag instead
+_MASK64 = 2 ** 64 - 1
+_GOLDEN = 0x9E3779B97F4A7C15  # fibonacci hashing, spreads sequential ids over the whole table
+_GOLDEN2 = 0xC2B2AE3D27D4EB4F
+_MAX_LOAD = 2 / 3
+
+
+def int64_key(value: int | str | None) -> int:
+    if isinstance(value, str):
+        return int.from_bytes(blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+    if value is None:
+        return int64_key('\x00None')
+    return int(value)
+
+
+def _capacity(size: int) -> int:
+    capacity = 16
+    while capacity * _MAX_LOAD < size:
+        capacity *= 2
+    return capacity
+
+
+class IntSet:
+    """set of int (or str) keys, supports add, in and len."""
+
+    def __init__(self, size: int = 0):
+        self._allocate(_capacity(size))
+        self._len = 0
+        self._has_empty = False
+
+    def clear(self):
+        self.__init__()
+
+    def _allocate(self, capacity: int):
+        self._slots = array('q', [EMPTY]) * capacity
+        self._shift = 64 - (capacity.bit_length() - 1)
+
+    def _find(self, key: int) -> int:
+        """Index of the slot holding `key` or of the free slot where it would go."""
+        slots = self._slots
+        mask = len(slots) - 1
+        i = ((key * _GOLDEN) & _MASK64) >> self._shift
+        while True:
+            slot = slots[i]
+            if slot == key or slot == EMPTY:
+                return i
+            i = (i + 1) & mask
+
+    def __contains__(self, value) -> bool:
+        key = int64_key(value)
+        if key == EMPTY:
+            return self._has_empty
+        return self._slots[self._find(key)] == key
+
+    def add(self, value):
+        key = int64_key(value)
+        if key == EMPTY:
+            if not self._has_empty:
+                self._has_empty = True
+                self._len += 1
+            return
+        i = self._find(key)
+        if self._slots[i] == key:
+            return
+        self._slots[i] = key
+        self._len += 1
+        if self._len > len(self._slots) * _MAX_LOAD:
+            self._grow()
+
+    def _grow(self):
+        old = self._slots
+        self._allocate(len(old) * 2)
+        for key in old:
+            if key != EMPTY:
+                self._slots[self._find(key)] = key
+
+    def __len__(self) -> int:
+        return self._len
+
+    def nbytes(self) -> int:
+        return self._slots.itemsize * len(self._slots)
+
+    def bytes_per_entry(self) -> float:
+        return self.nbytes() / self._len if self._len else 0.0
+
+
+class PairSet:
+    """set of 2-tuples of int (or str) keys, e.g. (tweet_id, hashtag_id), supports add, in and len."""
+
+    def __init__(self, size: int = 0):
+        self._allocate(_capacity(size))
+        self._len = 0
+        self._with_empty: set[tuple[int, int]] = set()  # pairs whose first key is EMPTY, practically never used
+
+    def clear(self):
+        self.__init__()
+
+    def _allocate(self, capacity: int):
+        self._first = array('q', [EMPTY]) * capacity
+        self._second = array('q', [0]) * capacity
+        self._shift = 64 - (capacity.bit_length() - 1)
+
+    def _find(self, a: int, b: int) -> int:
+        first = self._first
+        second = self._second
+        mask = len(first) - 1
+        i = (((a * _GOLDEN) ^ (b * _GOLDEN2)) & _MASK64) >> self._shift
+        while True:
+            slot = first[i]
+            if slot == EMPTY or (slot == a and second[i] == b):
+                return i
+            i = (i + 1) & mask
+
+    def __contains__(self, pair) -> bool:
+        a, b = int64_key(pair[0]), int64_key(pair[1])
+        if a == EMPTY:
+            return (a, b) in self._with_empty
+        return self._first[self._find(a, b)] != EMPTY
+
+    def add(self, pair):
+        a, b = int64_key(pair[0]), int64_key(pair[1])
+        if a == EMPTY:
+            if (a, b) not in self._with_empty:
+                self._with_empty.add((a, b))
+                self._len += 1
+            return
+        i = self._find(a, b)
+        if self._first[i] != EMPTY:
+            return
+        self._first[i] = a
+        self._second[i] = b
+        self._len += 1
+        if self._len > len(self._first) * _MAX_LOAD:
+            self._grow()
+
+    def _grow(self):
+        old_first, old_second = self._first, self._second
+        self._allocate(len(old_first) * 2)
+        for a, b in zip(old_first, old_second):
+            if a != EMPTY:
+                i = self._find(a, b)
+                self._first[i] = a
+                self._second[i] = b
+
+    def __len__(self) -> int:
+        return self._len
+
+    def nbytes(self) -> int:
+        return self._first.itemsize * len(self._first) + self._second.itemsize * len(self._second)
+
+    def bytes_per_entry(self) -> float:
+        return self.nbytes() / self._len if self._len else 0.0
+
+
+# file layout: header, then the slot arrays one after another (native int64)
+_HEADER = struct.Struct('=8sqqqq')  # magic, capacity, count, has_empty, closed cleanly
+_INT_MAGIC = b'PDTIDS01'
+_PAIR_MAGIC = b'PDTPRS01'
+_open_tables = set()  # for DEDUP_RAM_MB, the budget is split between them
+_FAULT_BYTES = 16 * mmap.PAGESIZE
+
+
+def _create_file(path: str, magic: bytes, capacity: int, fills: list[int]):
+    block_size = min(capacity, 1 << 16)
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(magic, capacity, 0, 0, 1))
+        for fill in fills:
+            block = (array('q', [fill]) * block_size).tobytes()
+            for _ in range(capacity // block_size):
+                f.write(block)
+
+
+class _MappedTable:
+    """Memory mapped storage shared by DiskIntSet and DiskPairSet."""
+    magic: bytes
+    fills: list[int]
+    path: str
+
+    def _map(self, path: str):
+        self._file = open(path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        if hasattr(self._mmap, "madvise"):
+            self._mmap.madvise(mmap.MADV_RANDOM)  # lookups are random, readahead would only evict useful pages
+        magic, capacity, count, has_empty, clean = _HEADER.unpack_from(self._mmap, 0)
+        if magic != self.magic:
+            raise ValueError(f"{path} is not a dedup index of this kind")
+        data = memoryview(self._mmap)[_HEADER.size:]
+        views = [data[i * capacity * 8:(i + 1) * capacity * 8].cast('q') for i in range(len(self.fills))]
+        data.release()
+        # mark the file as in use, a file that wasn't closed has a stale count in its header
+        _HEADER.pack_into(self._mmap, 0, magic, capacity, count, has_empty, 0)
+        return views, capacity, count, has_empty, clean
+
+    def _attach(self):
+        self._load()
+        self._touched = 0
+        _open_tables.add(self)
+
+    def _touch(self):
+        # every lookup is counted as a fault, linux maps up to 16 pages around one. That's mostly more than it really
+        # takes up, so the budget isn't exceeded
+        if DEDUP_RAM_MB:
+            self._touched += 1
+            if self._touched * _FAULT_BYTES >= DEDUP_RAM_MB * 2 ** 20 / len(_open_tables):
+                self.release_pages()
+
+    def release_pages(self):
+        """Unmaps the pages from the process, later lookups map them in again. Dirty pages stay in the page cache
+        until the kernel has written them back, then it can drop them."""
+        self._touched = 0
+        if hasattr(self._mmap, "madvise"):
+            self._mmap.madvise(mmap.MADV_DONTNEED)
+
+    def _unmap(self, views):
+        for view in views:
+            view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def _write_header(self, clean: int):
+        _HEADER.pack_into(self._mmap, 0, self.magic, self._capacity(), self._len, self._header_has_empty(), clean)
+
+    def flush(self):
+        self._write_header(0)
+        self._mmap.flush()
+
+    def close(self):
+        self._write_header(1)
+        self._mmap.flush()
+        self._unmap(self._views())
+        _open_tables.discard(self)
+
+    def clear(self):
+        self.close()
+        _create_file(self.path, self.magic, _capacity(0), self.fills)
+        self._attach()
+
+    def _grow(self):
+        # rehash into a twice as big file next to the old one and swap them. Both files are closed before the swap,
+        # windows can't replace a file that is still open or mapped.
+        old_views, old_mmap, old_file = self._views(), self._mmap, self._file
+        grow_path = self.path + ".grow"
+        _create_file(grow_path, self.magic, self._capacity() * 2, self.fills)
+        views, capacity, _, _, _ = self._map(grow_path)
+        self._set_views(views, capacity)
+        self._rehash(old_views)
+        self.close()
+        for view in old_views:
+            view.release()
+        old_mmap.close()
+        old_file.close()
+        os.replace(grow_path, self.path)
+        self._attach()
+        if DEDUP_RAM_MB:
+            self.release_pages()  # the rehash went through every page
+
+
+class DiskIntSet(_MappedTable, IntSet):
+    """IntSet in a memory mapped file, only the pages that are touched take up RAM (page cache, not heap).
+
+    The file stays valid after close(), opening the same path again gives back the same keys.
+    """
+    magic = _INT_MAGIC
+    fills = [EMPTY]
+
+    def __init__(self, path: str, size: int = 0):
+        self.path = path
+        if not os.path.exists(path):
+            _create_file(path, self.magic, _capacity(size), self.fills)
+        self._attach()
+
+    def _load(self):
+        views, capacity, count, has_empty, clean = self._map(self.path)
+        self._set_views(views, capacity)
+        self._has_empty = bool(has_empty)
+        self._len = count if clean else sum(1 for key in self._slots if key != EMPTY) + self._has_empty
+
+    def __contains__(self, value) -> bool:
+        self._touch()
+        return IntSet.__contains__(self, value)
+
+    def add(self, value):
+        self._touch()
+        IntSet.add(self, value)
+
+    def _set_views(self, views, capacity: int):
+        (self._slots,) = views
+        self._shift = 64 - (capacity.bit_length() - 1)
+
+    def _rehash(self, old_views):
+        for key in old_views[0]:
+            if key != EMPTY:
+                self._slots[self._find(key)] = key
+
+    def _capacity(self) -> int:
+        return len(self._slots)
+
+    def _header_has_empty(self) -> int:
+        return int(self._has_empty)
+
+    def _views(self):
+        return [self._slots]
+
+
+class DiskPairSet(_MappedTable, PairSet):
+    """PairSet in a memory mapped file, see DiskIntSet. Pairs starting with EMPTY (-2**63) aren't persisted."""
+    magic = _PAIR_MAGIC
+    fills = [EMPTY, 0]
+
+    def __init__(self, path: str, size: int = 0):
+        self.path = path
+        if not os.path.exists(path):
+            _create_file(path, self.magic, _capacity(size), self.fills)
+        self._attach()
+
+    def _load(self):
+        views, capacity, count, _, clean = self._map(self.path)
+        self._set_views(views, capacity)
+        self._with_empty = set()
+        self._len = count if clean else sum(1 for key in self._first if key != EMPTY)
+
+    def __contains__(self, pair) -> bool:
+        self._touch()
+        return PairSet.__contains__(self, pair)
+
+    def add(self, pair):
+        self._touch()
+        PairSet.add(self, pair)
+
+    def _set_views(self, views, capacity: int):
+        self._first, self._second = views
+        self._shift = 64 - (capacity.bit_length() - 1)
+
+    def _rehash(self, old_views):
+        for a, b in zip(*old_views):
+            if a != EMPTY:
+                i = self._find(a, b)
+                self._first[i] = a
+                self._second[i] = b
+
+    def _capacity(self) -> int:
+        return len(self._first)
+
+    def _header_has_empty(self) -> int:
+        return 0
+
+    def _views(self):
+        return [self._first, self._second]
+
+
+def new_id_set(name: str, directory: str = DEDUP_DIR) -> set | IntSet:
+    """Registry for single keys, `name` is the file name of the disk backend."""
+    if DEDUP_BACKEND == "disk":
+        os.makedirs(directory, exist_ok=True)
+        return DiskIntSet(os.path.join(directory, f"{name}.ids"))
+    return IntSet() if DEDUP_BACKEND == "compact" else set()
+
+
+def new_pair_set(name: str, directory: str = DEDUP_DIR) -> set | PairSet:
+    """Registry for pair keys, `name` is the file name of the disk backend."""
+    if DEDUP_BACKEND == "disk":
+        os.makedirs(directory, exist_ok=True)
+        return DiskPairSet(os.path.join(directory, f"{name}.pairs"))
+    return PairSet() if DEDUP_BACKEND == "compact" else set()
+
+
+def clear_registries(registries):
+    """Empties the registries, the disk backed ones could still hold the keys of an earlier run or export."""
+    for registry in registries:
+        registry.clear()
+
+
+def close_registries(registries):
+    """Writes the disk backed registries back, a no-op for the in-memory ones."""
+    for registry in registries:
+        if hasattr(registry, "close"):
+            registry.close()
+
+
+def memory_report(registries: dict[str, set | IntSet | PairSet]) -> str:
+    """Bytes per entry of the compact registries, for the log."""
+    return ", ".join(f"{name}: {registry.bytes_per_entry():.1f} B/entry"
+                     for name, registry in registries.items() if hasattr(registry, "bytes_per_entry"))
@@ -1,138 +1,168 @@
-import json
-from time import time, sleep
+from time import time, sleep, perf_counter
 import concurrent.futures as cf
-import threading
+from contextlib import closing
 from utils import *
 from schema import *
 from psycopg2.pool import ThreadedConnectionPool
+from jsonl_reader import *
+from compact_sets import new_id_set, clear_registries, close_registries
+from tweet_decoder import decode_line
+from copy_loader import LoadStats, copy_batches
+from tweet_batches import SeenTweets, new_batches, add_tweet
+from pipeline import Pipeline
+from manifest import Manifest, RESUME
+from metrics import metrics
+from autotune import AutoTuner
+from hashtag_cache import HASHTAG_CACHE, hashtag_cache, insert_hashtags
+from staging_loader import worker_id, create_worker_stages, drop_worker_stages, stage_batches, merge_stages
 from logger import Logger
 
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", 100))
 RETRY_LIMIT = int(os.getenv("RETRY_LIMIT", 3))
 WORKER_COUNT = int(os.getenv("WORKER_COUNT", 16))
+# "insert" runs the executemany INSERTs from utils, "copy" streams every batch with COPY (see copy_loader),
+# "staging" appends to per worker staging tables and merges them once all files are read (see staging_loader),
+# "pipeline" only parses here and leaves the writing to one writer thread per table (see pipeline)
+LOAD_MODE = os.getenv("LOAD_MODE", "insert")
+MANIFEST_PATH = os.getenv("MANIFEST_PATH", "upload_manifest.json")
+# debug cap, only the first lines of every file are loaded (0 loads everything)
+MAX_LINES_PER_FILE = int(os.getenv("MAX_LINES_PER_FILE", 1000))
 
 log = Logger()
 
 
-def process_file(tweets_file_path, max_line: int|None = None):
+def process_file(chunk: Chunk, max_line: int|None = None) -> tuple[int, list[int]] | None:
+    """Returns the batch count and the tweet ids still waiting for the chunk to be merged (staging and pipeline) once
+    the whole chunk is read, None if it stopped early."""
+    tweets_file_path = chunk.path
+    complete = False
+    # insert and copy commit batch by batch, so a restart continues after the last committed one
+    first_batch = manifest.batches(chunk)
 
     line_count = 0
+    batch_count = 0
+    batch_lines = 0  # lines parsed since the last written batch
+    retry_count = 0
+    batch_size = autotuner.batch_size
     time_before = time()
-    users_batch: list[User] = []
-    places_batch: list[Place] = []
-    tweets_batch: list[Tweet] = []
-    hashtags_batch: list[tuple[int, Hashtag]] = []
-    urls_batch: list[tuple[int, Url]] = []
-    media_batch: list[tuple[int, Media]] = []
-    temp_user_mentions_batch: list[tuple[int, UserMention]] = []
-
-    # 10572/10571/10570 for 1000, 191/83 seconds; without 9962, 9964, 9967 entries 101/89 seconds
-    def merge_entities(entities: dict, extended_entities: dict) -> dict:
-        if not extended_entities:
-            return entities or {}
-        if not entities:
-            return extended_entities or {}
-
-        merged = entities.copy()
-        for key, ext_val in extended_entities.items():
-            ent_val = merged.get(key)
-            if isinstance(ext_val, list):
-                # Merge lists, unique by 'id' if present
-                seen_media_ids = set()
-                merged_list = []
-                for item in (ent_val or []) + ext_val:
-                    item_id = item.get('id') if isinstance(item, dict) else None
-                    if item_id is not None:
-                        if item_id not in seen_media_ids:
-                            seen_media_ids.add(item_id)
-                            merged_list.append(item)
-                    else:
-                        merged_list.append(item)
-                merged[key] = merged_list
-            else:
-                merged[key] = ext_val
-        return merged
-
-    def parse_tweet(_tweet: Tweet):
-        with seen_ids_lock:
-            if _tweet.id in seen_ids:
-                return
-            seen_ids.add(_tweet.id)
-
-        if _tweet.user:
-            users_batch.append(_tweet.user)
-        if _tweet.place:
-            places_batch.append(_tweet.place)
-        tweets_batch.append(_tweet)
-        if _tweet.entities:
-            if _tweet.entities.hashtags:
-                for hashtag in _tweet.entities.hashtags:
-                    hashtags_batch.append((_tweet.id, hashtag))
-            if _tweet.entities.urls:
-                for url in _tweet.entities.urls:
-                    urls_batch.append((_tweet.id, url))
-            if _tweet.entities.media:
-                for media in _tweet.entities.media:
-                    media_batch.append((_tweet.id, media))
-            if _tweet.entities.user_mentions:
-                for user_mention in _tweet.entities.user_mentions:
-                    temp_user_mentions_batch.append((_tweet.id, user_mention))
-
-        if _tweet.quoted_status:
-            parse_tweet(_tweet.quoted_status)
-        if _tweet.retweeted_status:
-            parse_tweet(_tweet.retweeted_status)
+    batches = new_batches()
+    pending_ids: list[int] = []  # tweets of the batches that aren't committed yet
+    users_batch: list[User] = batches["users"]
+    places_batch: list[Place] = batches["places"]
+    tweets_batch: list[Tweet] = batches["tweets"]
+    hashtags_batch: list[tuple[int, Hashtag]] = batches["hashtags"]
+    urls_batch: list[tuple[int, Url]] = batches["urls"]
+    media_batch: list[tuple[int, Media]] = batches["medias"]
+    temp_user_mentions_batch: list[tuple[int, UserMention]] = batches["temp_user_mentions"]
 
     def try_insert_with_retries(insert_func, args, batch, _conn, name):
+        nonlocal retry_count
         for i in range(RETRY_LIMIT):
             try:
+                time_before_insert = perf_counter()
                 insert_func(*args)
                 _conn.commit()
+                load_stats.add(name, len(batch), perf_counter() - time_before_insert)
                 batch.clear()
                 return True
             except psycopg2.Error:
-                log.error(f"Deadlock with {name}, retrying {i + 1}/{RETRY_LIMIT}", False)
+                log.warning(f"Deadlock with {name}, retrying {i + 1}/{RETRY_LIMIT}", False)
+                metrics.inc("retries_total", table=name)
+                retry_count += 1
                 _conn.rollback()
                 sleep(1)
         return False
 
+    def try_copy_with_retries(_conn):
+        nonlocal retry_count
+        for i in range(RETRY_LIMIT):
+            try:
+                if LOAD_MODE == "staging":
+                    stage_batches(cur, worker_id(), batches, load_stats)
+                else:
+                    copy_batches(cur, batches, load_stats)
+                _conn.commit()
+                for batch in batches.values():
+                    batch.clear()
+                return True
+            except psycopg2.Error:
+                log.warning(f"Deadlock with copy, retrying {i + 1}/{RETRY_LIMIT}", False)
+                metrics.inc("retries_total", table=LOAD_MODE)
+                retry_count += 1
+                _conn.rollback()
+                sleep(1)
+        return False
+
+    def submit_to_pipeline():
+        pipeline.submit({name: list(batch) for name, batch in batches.items()}, chunk)
+        for batch in batches.values():
+            batch.clear()
+
+    def write_batch():
+        rows = sum(len(batch) for batch in batches.values())
+        retries_before = retry_count
+        time_before_write = perf_counter()
+        if LOAD_MODE in ("copy", "staging"):
+            # whole batch in one transaction, if it fails, it goes with the next batch
+            try_copy_with_retries(conn)
+        # try 3 times if deadlock detected, if fails, you will commit these with next batch
+        elif try_insert_with_retries(insert_users, (cur, users_batch), users_batch, conn, "users") and \
+                try_insert_with_retries(insert_places, (cur, places_batch), places_batch, conn, "places") and \
+                try_insert_with_retries(insert_tweets, (cur, tweets_batch), tweets_batch, conn, "tweets"):
+            try_insert_with_retries(insert_hashtags, (cur, hashtags_batch), hashtags_batch, conn, "hashtags")
+            try_insert_with_retries(insert_urls, (cur, urls_batch), urls_batch, conn, "urls")
+            try_insert_with_retries(insert_medias, (cur, media_batch), media_batch, conn, "medias")
+            try_insert_with_retries(insert_temp_user_mentions, (cur, temp_user_mentions_batch), temp_user_mentions_batch, conn, "temp_user_mentions")
+        autotuner.record(rows, perf_counter() - time_before_write, retry_count - retries_before)
+
     try:
         conn = pool.getconn()
         cur = conn.cursor()
 
-        with open(tweets_file_path, 'r') as file:
-            for line in file:
+        with closing(iter_raw_lines(chunk.path, manifest.resume_offset(chunk), chunk.end)) as file:
+            for line, offset in file:
                 if max_line and line_count >= max_line:
                     break
-                # Skip empty lines
-                if not line.strip():
-                    continue
-                tweet_json = json.loads(line)
-                if 'extended_entities' in tweet_json:
-                    tweet_json['entities'] = merge_entities(tweet_json.get('entities', {}),
-                                                            tweet_json['extended_entities'])
                 try:
-                    tweet = Tweet.model_validate(tweet_json)
-                    parse_tweet(tweet)
+                    # 10572/10571/10570 for 1000, 191/83 seconds; without 9962, 9964, 9967 entries 101/89 seconds
+                    tweet = decode_line(line)
+                    tweets_before = len(tweets_batch)
+                    add_tweet(batches, tweet, seen_tweets)
+                    pending_ids.extend(_tweet.id for _tweet in tweets_batch[tweets_before:])
 
                 except Exception as e:
                     log.error(f"Error parsing tweet JSON: {e}")
+                    metrics.inc("parse_failures_total")
                     break
                 line_count += 1
+                batch_lines += 1
+                if batch_lines < batch_size:
+                    continue
+
+                metrics.inc("lines_read_total", batch_lines)
+                batch_lines = 0
+                batch_count += 1
+                if LOAD_MODE == "pipeline":
+                    submit_to_pipeline()
+                else:
+                    # with AUTOTUNE only the tuner's number of workers write at the same time
+                    with autotuner.slot():
+                        write_batch()
+                    batch_size = autotuner.batch_size
 
-                if line_count % BATCH_SIZE == 0:
-                    # try 3 times if deadlock detected, if fails, you will commit these with next batch
-                    if not try_insert_with_retries(insert_users, (cur, users_batch), users_batch, conn, "users") or \
-                        not try_insert_with_retries(insert_places, (cur, places_batch), places_batch, conn, "places") :
-                        continue
-                    if not try_insert_with_retries(insert_tweets, (cur, tweets_batch), tweets_batch, conn, "tweets"):
-                        continue
-                    try_insert_with_retries(insert_hashtags_and_link, (cur, hashtags_batch), hashtags_batch, conn, "hashtags")
-                    try_insert_with_retries(insert_urls, (cur, urls_batch), urls_batch, conn, "urls")
-                    try_insert_with_retries(insert_medias, (cur, media_batch), media_batch, conn, "medias")
-                    try_insert_with_retries(insert_temp_user_mentions, (cur, temp_user_mentions_batch), temp_user_mentions_batch, conn, "temp_user_mentions")
+                if LOAD_MODE in ("insert", "copy") and not any(batches.values()):
+                    manifest.record(chunk, offset, first_batch + batch_count)
+                    seen_tweets.commit(pending_ids)
+                    pending_ids.clear()
+            else:
+                complete = True
 
         # insert remaining
+        if LOAD_MODE == "pipeline" and any(batches.values()):
+            submit_to_pipeline()
+        while LOAD_MODE in ("copy", "staging") and any(batches.values()):
+            try_copy_with_retries(conn)
+
         while len(users_batch) or len(places_batch):
             if len(users_batch):
                 try_insert_with_retries(insert_users, (cur, users_batch), users_batch, conn, "users")
@@ -144,7 +174,7 @@ def process_file(tweets_file_path, max_line: int|None = None):
 
         while len(hashtags_batch) or len(urls_batch) or len(media_batch) or len(temp_user_mentions_batch):
             if len(hashtags_batch):
-                try_insert_with_retries(insert_hashtags_and_link, (cur, hashtags_batch), hashtags_batch, conn, "hashtags")
+                try_insert_with_retries(insert_hashtags, (cur, hashtags_batch), hashtags_batch, conn, "hashtags")
             if len(urls_batch):
                 try_insert_with_retries(insert_urls, (cur, urls_batch), urls_batch, conn, "urls")
             if len(media_batch):
@@ -152,35 +182,110 @@ def process_file(tweets_file_path, max_line: int|None = None):
             if len(temp_user_mentions_batch):
                 try_insert_with_retries(insert_temp_user_mentions, (cur, temp_user_mentions_batch), temp_user_mentions_batch, conn, "temp_user_mentions")
 
-
+        if LOAD_MODE in ("insert", "copy"):
+            if complete:
+                manifest.record(chunk, chunk.end, first_batch + batch_count, done=True)
+            seen_tweets.commit(pending_ids)
+            pending_ids.clear()
 
     except Exception as e:
+        complete = False
         log.error(f"Error processing file {tweets_file_path}: {e}")
     finally:
         # return connection to pool
         pool.putconn(conn)
+        metrics.inc("lines_read_total", batch_lines)
         # Debug print
         time_after = time()
-        log.info(f"Inserted {line_count} tweets from {os.path.basename(tweets_file_path)} in {time_after - time_before:.2f} seconds.")
+        log.info(f"Inserted {line_count} tweets from {os.path.basename(tweets_file_path)} [{chunk.start}:{chunk.end}] in {time_after - time_before:.2f} seconds.")
+    return (first_batch + batch_count, pending_ids) if complete else None
 
 
 data_dir = "data"
-jsonl_files = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.endswith(".jsonl")]
-pool = ThreadedConnectionPool(minconn=1, maxconn=len(jsonl_files), dsn=get_dsn())
+jsonl_files = list_jsonl_files(data_dir)
+# big files are split into several chunks, biggest chunks are scheduled first. With the debug cap the files stay
+# whole, the cap counts the lines of a file, not of a chunk.
+if MAX_LINES_PER_FILE:
+    chunks = plan_chunks(jsonl_files, max((os.path.getsize(path) for path in jsonl_files), default=0) + 1)
+else:
+    chunks = plan_chunks(jsonl_files)
+# chunks finished by an earlier run (with the same input files) are skipped, RESUME=0 starts over
+manifest = Manifest(MANIFEST_PATH)
+pending_chunks = [chunk for chunk in chunks if not manifest.is_done(chunk)]
+if len(pending_chunks) < len(chunks):
+    log.info(f"Skipping {len(chunks) - len(pending_chunks)} chunks finished by an earlier run.")
+pool = ThreadedConnectionPool(minconn=1, maxconn=max(1, min(len(chunks), WORKER_COUNT)), dsn=get_dsn())
+
+# DEDUP_BACKEND=disk keeps the ids of committed batches, a later run skips those tweets without going to the database.
+# RESUME=0 starts over with an empty file.
+seen_ids = new_id_set("seen_ids")
+if not RESUME:
+    clear_registries([seen_ids])
+seen_tweets = SeenTweets(seen_ids)
 
-seen_ids = set()
-seen_ids_lock = threading.Lock()
+load_stats = LoadStats()
+# AUTOTUNE=1 adjusts the batch size and the number of writing workers while loading, see autotune
+autotuner = AutoTuner(BATCH_SIZE, WORKER_COUNT, log)
 
+if HASHTAG_CACHE:
+    hashtag_cache.preload()
+
+if LOAD_MODE == "staging":
+    stage_conn = pool.getconn()
+    with stage_conn.cursor() as stage_cur:
+        create_worker_stages(stage_cur, WORKER_COUNT)
+    stage_conn.commit()
+    pool.putconn(stage_conn)
+
+pipeline = Pipeline(get_connection, log, load_stats) if LOAD_MODE == "pipeline" else None
+
+metrics.start("concurrent_uploading")
 total_time_before = time()
 with cf.ThreadPoolExecutor(max_workers=WORKER_COUNT) as executor:
-    futures = [executor.submit(process_file, file_path, 1000) for file_path in jsonl_files]
+    futures = {executor.submit(process_file, chunk, MAX_LINES_PER_FILE or None): chunk for chunk in pending_chunks}
     # to check if all threads went fine
+    completed_chunks: list[tuple[Chunk, int, list[int]]] = []
     for future in cf.as_completed(futures):
         try:
-            future.result()
+            result = future.result()
+            if result is not None:
+                completed_chunks.append((futures[future], *result))
         except Exception as e:
             log.error(f"Error in thread: {e}")
 
+if pipeline:
+    pipeline.close()
+    # a chunk with a batch the writers gave up on is redone by the next run
+    for chunk in pipeline.failed_keys:
+        log.error(f"Not all batches of {os.path.basename(chunk.path)} [{chunk.start}:{chunk.end}] were written, "
+                  f"the chunk isn't marked as done")
+    completed_chunks = [completed for completed in completed_chunks if completed[0] not in pipeline.failed_keys]
+
+if LOAD_MODE == "staging":
+    merge_time_before = time()
+    stage_conn = pool.getconn()
+    with stage_conn.cursor() as stage_cur:
+        merge_stages(stage_cur, WORKER_COUNT, load_stats)
+        stage_conn.commit()
+        drop_worker_stages(stage_cur, WORKER_COUNT)
+        stage_conn.commit()
+    pool.putconn(stage_conn)
+    log.info(f"Merged staging tables in {time() - merge_time_before:.2f} seconds.")
+
+# staging and pipeline only have everything in the tables now, so their chunks are marked as done just here
+if LOAD_MODE in ("staging", "pipeline"):
+    for chunk, batch_count, tweet_ids in completed_chunks:
+        manifest.record(chunk, chunk.end, batch_count, done=True)
+        seen_tweets.commit(tweet_ids)
+
 total_time_after = time()
+metrics.stop()
 pool.closeall()
-log.info(f"Processed {len(jsonl_files)} files in {total_time_after - total_time_before:.2f} seconds.")
\ No newline at end of file
+close_registries([seen_ids])
+if HASHTAG_CACHE:
+    hashtag_cache.close()
+    log.info(f"Hashtag cache: {hashtag_cache.hits} hits, {hashtag_cache.misses} new tags")
+log.info(f"Rows per table ({LOAD_MODE}): {load_stats.report()}")
+if autotuner.enabled:
+    log.info(f"Autotune operating point: {autotuner.report()}")
+log.info(f"Processed {len(jsonl_files)} files ({len(chunks)} chunks) in {total_time_after - total_time_before:.2f} seconds.")
\ No newline at end of file
@@ -0,0 +1,184 @@
+import io
+import os
+import threading
+from collections import defaultdict
+from time import perf_counter
+from typing import NamedTuple
+from utils import *
+from pgcopy import copy_binary, table_types
+from metrics import metrics
+
+# COPY based alternative to the executemany INSERTs in utils. Every batch is serialized into in-memory COPY text
+# buffers, streamed with copy_expert into session local staging tables and moved into the real tables with one
+# INSERT ... SELECT ... ON CONFLICT per table, so there's no round trip per row and no csv files on disk.
+# COPY_FORMAT=binary sends the batches in the binary COPY format instead (see pgcopy), postgres then doesn't have to
+# parse the numbers and timestamps out of text.
+COPY_FORMAT = os.getenv("COPY_FORMAT", "text")
+
+
+class CopyTable(NamedTuple):
+    name: str  # same names concurrent_uploading uses for its batches
+    target: str
+    columns: tuple[str, ...]  # in the order of the *_to_insert_format tuples in utils
+    key: tuple[str, ...]
+    update: bool  # ON CONFLICT DO UPDATE like the insert queries in utils, otherwise DO NOTHING
+
+
+COPY_TABLES = [
+    CopyTable("users", "users",
+              ("id", "name", "screen_name", "location", "description", "followers_count", "friends_count",
+               "statuses_count", "created_at"), ("id",), True),
+    CopyTable("places", "places", ("id", "place_type", "full_name", "country_code", "country"), ("id",), True),
+    CopyTable("tweets", "tweets",
+              ("id", "created_at", "full_text", "display_from", "display_to", "lang", "user_id", "source",
+               "in_reply_to_status_id", "quoted_status_id", "retweeted_status_id", "place_id", "retweet_count",
+               "favorite_count", "possibly_sensitive"), ("id",), True),
+    # hashtags are staged as (tweet_id, tag), the ids only exist once the tags are in the hashtags table
+    CopyTable("hashtags", "tweet_hashtag", ("tweet_id", "tag"), ("tweet_id", "hashtag_id"), False),
+    CopyTable("urls", "tweet_urls", ("tweet_id", "url", "expanded_url", "display_url", "unwound_url"),
+              ("tweet_id", "url"), False),
+    CopyTable("medias", "tweet_media",
+              ("tweet_id", "media_id", "display_url", "expanded_url", "media_url", "media_url_https", "type"),
+              ("tweet_id", "media_id"), False),
+    CopyTable("temp_user_mentions", "temp_tweet_user_mentions",
+              ("tweet_id", "mentioned_user_id", "mentioned_screen_name", "mentioned_name"), (), False),
+]
+
+
+class LoadStats:
+    """Rows and seconds spent per table, shared by all workers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows: dict[str, int] = defaultdict(int)
+        self.seconds: dict[str, float] = defaultdict(float)
+
+    def add(self, table: str, rows: int, seconds: float):
+        with self._lock:
+            self.rows[table] += rows
+            self.seconds[table] += seconds
+        metrics.inc("rows_written_total", rows, table=table)
+        metrics.observe("batch_write_seconds", seconds, table=table)
+
+    def report(self) -> str:
+        with self._lock:
+            return ", ".join(f"{table}: {self.rows[table]} rows in {self.seconds[table]:.2f}s "
+                             f"({self.rows[table] / self.seconds[table] if self.seconds[table] else 0:.0f} rows/sec)"
+                             for table in self.rows)
+
+
+def copy_text(value) -> str:
+    """Formats one value for COPY ... FROM STDIN in the default text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return str(value)
+
+
+def to_copy_buffer(rows: list[tuple]) -> io.StringIO:
+    buffer = io.StringIO()
+    buffer.writelines('\t'.join([copy_text(value) for value in row]) + '\n' for row in rows)
+    buffer.seek(0)
+    return buffer
+
+
+def stage_name(table: CopyTable) -> str:
+    return f"stage_{table.target}"
+
+
+def stage_columns(table: CopyTable) -> str:
+    if table.name == "hashtags":
+        return "(tweet_id BIGINT, tag TEXT)"
+    return f"(LIKE {table.target} INCLUDING DEFAULTS)"
+
+
+def stage_types(table: CopyTable) -> list[str]:
+    if table.name == "hashtags":
+        return ["bigint", "text"]
+    return table_types(table.target, table.columns)
+
+
+def create_stage_tables(cursor):
+    # temp tables live as long as the pooled connection, ON COMMIT DELETE ROWS empties them after every batch.
+    # All in one statement, it's a single round trip per batch once they exist.
+    cursor.execute("\n".join(f"CREATE TEMP TABLE IF NOT EXISTS {stage_name(table)} {stage_columns(table)} "
+                             f"ON COMMIT DELETE ROWS;" for table in COPY_TABLES))
+
+
+def merge_query(table: CopyTable, source: str) -> str:
+    """INSERT ... SELECT from the staging table `source` into the target table of `table`."""
+    # every query inserts in the order of the conflict key, so concurrent workers take the unique index locks in the
+    # same order and don't deadlock on each other
+    if table.name == "hashtags":
+        return f"""
+        INSERT INTO hashtags (tag)
+        SELECT DISTINCT tag FROM {source} ORDER BY tag
+        ON CONFLICT (tag) DO NOTHING;
+        INSERT INTO tweet_hashtag (tweet_id, hashtag_id)
+        SELECT DISTINCT s.tweet_id, h.id FROM {source} s JOIN hashtags h ON h.tag = s.tag ORDER BY s.tweet_id, h.id
+        ON CONFLICT DO NOTHING;
+        """
+
+    columns = ", ".join(table.columns)
+    key = ", ".join(table.key)
+    if not table.update:
+        # temp_tweet_user_mentions has no key, nothing to conflict on
+        order = f" ORDER BY {key}" if key else ""
+        return f"INSERT INTO {table.target} ({columns}) SELECT {columns} FROM {source}{order} ON CONFLICT DO NOTHING;"
+
+    # one row per key, ON CONFLICT DO UPDATE can't touch the same row twice in one statement
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in table.columns if column not in table.key)
+    return f"""
+    INSERT INTO {table.target} ({columns})
+    SELECT DISTINCT ON ({key}) {columns} FROM {source} ORDER BY {key}
+    ON CONFLICT ({key}) DO UPDATE SET {updates};
+    """
+
+
+def batch_rows(table: CopyTable, batch: list) -> list[tuple]:
+    if table.name == "users":
+        return [user_to_insert_format(user) for user in batch]
+    if table.name == "places":
+        return [place_to_insert_format(place) for place in batch]
+    if table.name == "tweets":
+        return [tweet_to_insert_format(tweet) for tweet in batch]
+    if table.name == "hashtags":
+        return [(tweet_id, hashtag.text) for tweet_id, hashtag in batch]
+    if table.name == "urls":
+        return [insert_url_format(tweet_id, url) for tweet_id, url in batch]
+    if table.name == "medias":
+        return [insert_media_format(tweet_id, media) for tweet_id, media in batch]
+    return [user_mention_to_insert_format(tweet_id, user_mention) for tweet_id, user_mention in batch]
+
+
+def copy_rows(cursor, table: CopyTable, destination: str, rows: list[tuple]):
+    """COPYs the rows of `table` into the table `destination`, which has the staging columns."""
+    if COPY_FORMAT == "binary":
+        copy_binary(cursor, destination, table.columns, rows, stage_types(table))
+    else:
+        cursor.copy_expert(f"COPY {destination} ({', '.join(table.columns)}) FROM STDIN", to_copy_buffer(rows))
+
+
+def copy_table(cursor, table: CopyTable, rows: list[tuple]):
+    copy_rows(cursor, table, stage_name(table), rows)
+    cursor.execute(merge_query(table, stage_name(table)))
+
+
+def copy_batches(cursor, batches: dict[str, list], stats: LoadStats | None = None):
+    """Loads all batches (keyed by CopyTable.name) in one transaction, the caller commits."""
+    create_stage_tables(cursor)
+    timings = []
+    for table in COPY_TABLES:
+        batch = batches.get(table.name)
+        if not batch:
+            continue
+        time_before = perf_counter()
+        copy_table(cursor, table, batch_rows(table, batch))
+        timings.append((table.name, len(batch), perf_counter() - time_before))
+    # counted only after every table went through, a batch failing halfway is retried and would be counted twice
+    if stats:
+        for name, rows, seconds in timings:
+            stats.add(name, rows, seconds)
@@ -0,0 +1,28 @@
+from schema import *
+
+# What counting counts, the same keys for the exact sets and the --approx sketches (benchmarks.bench_stages times
+# the same code).
+
+COUNTED = ["users", "places", "tweets", "hashtags", "urls", "media", "user_mentions"]
+
+
+def count_tweet(_tweet: Tweet, add):
+    """Hands the keys of the tweet and its nested tweets to add(name, keys), one call per tweet and entity type."""
+    add("tweets", (_tweet.id,))
+    if _tweet.user:
+        add("users", (_tweet.user.id,))
+    if _tweet.place:
+        add("places", (_tweet.place.id,))
+    if _tweet.entities:
+        if _tweet.entities.hashtags:
+            add("hashtags", [hashtag.text.lower() for hashtag in _tweet.entities.hashtags])
+        if _tweet.entities.urls:
+            add("urls", [(_tweet.id, url.url) for url in _tweet.entities.urls])
+        if _tweet.entities.media:
+            add("media", [(_tweet.id, media.id) for media in _tweet.entities.media])
+        if _tweet.entities.user_mentions:
+            add("user_mentions", [(_tweet.id, user_mention.id) for user_mention in _tweet.entities.user_mentions])
+    if _tweet.quoted_status:
+        count_tweet(_tweet.quoted_status, add)
+    if _tweet.retweeted_status:
+        count_tweet(_tweet.retweeted_status, add)
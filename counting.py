@@ -1,150 +1,150 @@
-import json
 from time import time
 import concurrent.futures as cf
+import shutil
+import sys
+import tempfile
 import threading
+from contextlib import closing
 from utils import *
 from schema import *
+from tweet_decoder import decode_line
+from compact_sets import *
+from jsonl_reader import list_jsonl_files, iter_records
 from logger import Logger
+from metrics import metrics
+from hyperloglog import HyperLogLog
+from count_keys import COUNTED, count_tweet
+
+# --approx counts with HyperLogLog sketches instead of the sets below, every file gets its own sketches (no locks)
+# and they are merged at the end, a few KB per entity type instead of every id
+APPROX = "--approx" in sys.argv[1:]
 
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", 100))
 WORKER_COUNT = int(os.getenv("WORKER_COUNT", 16))
 
 log = Logger()
 
-# --- Global sets and individual locks ---
-users_set: set[int] = set()
-users_lock = threading.Lock()
+# --approx needs none of the sets and locks below
+if not APPROX:
+    # disk registries go to a directory of their own, removed again at the end, so every run counts just its own input
+    if DEDUP_BACKEND == "disk":
+        os.makedirs(DEDUP_DIR, exist_ok=True)
+        registry_dir = tempfile.mkdtemp(prefix="counting_", dir=DEDUP_DIR)
+    else:
+        registry_dir = DEDUP_DIR
+
+    # --- Global sets and individual locks ---
+    users_set: set[int] = new_id_set("counting_users", registry_dir)
+    users_lock = threading.Lock()
 
-places_set: set[str] = set()
-places_lock = threading.Lock()
+    places_set: set[str] = new_id_set("counting_places", registry_dir)
+    places_lock = threading.Lock()
 
-tweets_set: set[int] = set()
-tweets_lock = threading.Lock()
+    tweets_set: set[int] = new_id_set("counting_tweets", registry_dir)
+    tweets_lock = threading.Lock()
 
-hashtags_set: set[str] = set()
-hashtags_lock = threading.Lock()
+    hashtags_set: set[str] = new_id_set("counting_hashtags", registry_dir)
+    hashtags_lock = threading.Lock()
 
-tweet_hashtags_set: set[tuple[int, str]] = set()
-tweet_hashtags_lock = threading.Lock()
+    tweet_hashtags_set: set[tuple[int, str]] = new_pair_set("counting_tweet_hashtags", registry_dir)
+    tweet_hashtags_lock = threading.Lock()
 
-urls_set: set[tuple[int, str]] = set()
-urls_lock = threading.Lock()
+    urls_set: set[tuple[int, str]] = new_pair_set("counting_urls", registry_dir)
+    urls_lock = threading.Lock()
 
-media_set: set[tuple[int, int]] = set()
-media_lock = threading.Lock()
+    media_set: set[tuple[int, int]] = new_pair_set("counting_media", registry_dir)
+    media_lock = threading.Lock()
 
-user_mentions_set: set[tuple[int, int]] = set()
-user_mentions_lock = threading.Lock()
-# --- End global sets and locks ---
+    user_mentions_set: set[tuple[int, int]] = new_pair_set("counting_user_mentions", registry_dir)
+    user_mentions_lock = threading.Lock()
+    # --- End global sets and locks ---
+    counted = {"users": (users_set, users_lock), "places": (places_set, places_lock),
+               "tweets": (tweets_set, tweets_lock), "hashtags": (hashtags_set, hashtags_lock),
+               "urls": (urls_set, urls_lock), "media": (media_set, media_lock),
+               "user_mentions": (user_mentions_set, user_mentions_lock)}
 
-def process_file(tweets_file_path, max_line: int|None = None):
+def process_file(tweets_file_path, max_line: int|None = None) -> dict[str, HyperLogLog] | None:
+    """Returns the file's sketches with --approx."""
     line_count = 0
     time_before = time()
+    sketches = {name: HyperLogLog() for name in COUNTED} if APPROX else None
+
+    def add_to_set(name: str, keys):
+        registry, lock = counted[name]
+        with lock:
+            for key in keys:
+                registry.add(key)
+
+    def add_to_sketch(name: str, keys):
+        # the file's own sketches, no locks
+        sketch = sketches[name]
+        for key in keys:
+            sketch.add(key)
 
-    # 10572/10571/10570 for 1000, 191/83 seconds; without 9962, 9964, 9967 entries 101/89 seconds
-    def merge_entities(entities: dict, extended_entities: dict) -> dict:
-        if not extended_entities:
-            return entities or {}
-        if not entities:
-            return extended_entities or {}
-
-        merged = entities.copy()
-        for key, ext_val in extended_entities.items():
-            ent_val = merged.get(key)
-            if isinstance(ext_val, list):
-                # Merge lists, unique by 'id' if present
-                seen_media_ids = set()
-                merged_list = []
-                for item in (ent_val or []) + ext_val:
-                    item_id = item.get('id') if isinstance(item, dict) else None
-                    if item_id is not None:
-                        if item_id not in seen_media_ids:
-                            seen_media_ids.add(item_id)
-                            merged_list.append(item)
-                    else:
-                        merged_list.append(item)
-                merged[key] = merged_list
-            else:
-                merged[key] = ext_val
-        return merged
-
-    def parse_tweet(_tweet: Tweet):
-        # Tweets
-        with tweets_lock:
-            tweets_set.add(_tweet.id)
-        # Users
-        if _tweet.user:
-            with users_lock:
-                users_set.add(_tweet.user.id)
-        # Places
-        if _tweet.place:
-            with places_lock:
-                places_set.add(_tweet.place.id)
-        # Entities
-        if _tweet.entities:
-            if _tweet.entities.hashtags:
-                with hashtags_lock:
-                    for hashtag in _tweet.entities.hashtags:
-                        hashtags_set.add(hashtag.text.lower())
-            if _tweet.entities.urls:
-                with urls_lock:
-                    for url in _tweet.entities.urls:
-                        urls_set.add((_tweet.id, url.url))
-            if _tweet.entities.media:
-                with media_lock:
-                    for media in _tweet.entities.media:
-                        media_set.add((_tweet.id, media.id))
-            if _tweet.entities.user_mentions:
-                with user_mentions_lock:
-                    for user_mention in _tweet.entities.user_mentions:
-                        user_mentions_set.add((_tweet.id, user_mention.id))
-        if _tweet.quoted_status:
-            parse_tweet(_tweet.quoted_status)
-        if _tweet.retweeted_status:
-            parse_tweet(_tweet.retweeted_status)
+    add = add_to_sketch if APPROX else add_to_set
 
     try:
-        with open(tweets_file_path, 'r') as file:
-            for line in file:
+        with closing(iter_records(tweets_file_path)) as lines:
+            for line in lines:
                 if max_line and line_count >= max_line:
                     break
-                # Skip empty lines
-                if not line.strip():
-                    continue
-                tweet_json = json.loads(line)
-                if 'extended_entities' in tweet_json:
-                    tweet_json['entities'] = merge_entities(tweet_json.get('entities', {}),
-                                                            tweet_json['extended_entities'])
                 try:
-                    tweet = Tweet.model_validate(tweet_json)
-                    parse_tweet(tweet)
+                    # 10572/10571/10570 for 1000, 191/83 seconds; without 9962, 9964, 9967 entries 101/89 seconds
+                    tweet = decode_line(line)
+                    count_tweet(tweet, add)
 
                 except Exception as e:
                     log.error(f"Error parsing tweet JSON: {e}")
+                    metrics.inc("parse_failures_total")
                     break
                 line_count += 1
+                if line_count % BATCH_SIZE == 0:
+                    metrics.inc("lines_read_total", BATCH_SIZE)
 
     except Exception as e:
         log.error(f"Error processing file {tweets_file_path}: {e}")
     finally:
+        metrics.inc("lines_read_total", line_count % BATCH_SIZE)
         # Debug print
         time_after = time()
         log.info(f"Processed {line_count} tweets from {os.path.basename(tweets_file_path)} in {time_after - time_before:.2f} seconds.")
+    return sketches
 
 
 data_dir = "data"
-jsonl_files = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.endswith(".jsonl")]
+jsonl_files = list_jsonl_files(data_dir)
 
+metrics.start("counting")
 total_time_before = time()
+merged = {name: HyperLogLog() for name in COUNTED}
 with cf.ThreadPoolExecutor(max_workers=WORKER_COUNT) as executor:
     futures = [executor.submit(process_file, file_path) for file_path in jsonl_files]
     # to check if all threads went fine
     for future in cf.as_completed(futures):
         try:
-            future.result()
+            file_sketches = future.result()
+            if file_sketches:
+                for name, sketch in file_sketches.items():
+                    merged[name].merge(sketch)
         except Exception as e:
             log.error(f"Error in thread: {e}")
 
 total_time_after = time()
-log.info(f"Unique users: {len(users_set)}, places: {len(places_set)}, tweets: {len(tweets_set)}, hashtags: {len(hashtags_set)}, urls: {len(urls_set)}, media: {len(media_set)}, user_mentions: {len(user_mentions_set)}")
+metrics.stop()
+if APPROX:
+    # +-2 standard errors, ~95% of the runs are within that
+    log.info("Approximate unique " + ", ".join(
+        f"{name}: {sketch.count()} (+-{2 * sketch.relative_error() * sketch.count():.0f})" for name, sketch in merged.items()))
+    log.info(f"Sketch memory: {sum(sketch.nbytes() for sketch in merged.values())} bytes for the merged sketches, "
+             f"the same again for every file being counted")
+else:
+    log.info(f"Unique users: {len(users_set)}, places: {len(places_set)}, tweets: {len(tweets_set)}, hashtags: {len(hashtags_set)}, urls: {len(urls_set)}, media: {len(media_set)}, user_mentions: {len(user_mentions_set)}")
+    if DEDUP_BACKEND != "python":
+        log.info("Dedup memory: " + memory_report({"users": users_set, "places": places_set, "tweets": tweets_set,
+                                                   "hashtags": hashtags_set, "urls": urls_set, "media": media_set,
+                                                   "user_mentions": user_mentions_set}))
+    close_registries([users_set, places_set, tweets_set, hashtags_set, tweet_hashtags_set, urls_set, media_set,
+                      user_mentions_set])
+    if DEDUP_BACKEND == "disk":
+        shutil.rmtree(registry_dir)
 log.info(f"Processed {len(jsonl_files)} files in {total_time_after - total_time_before:.2f} seconds.")
\ No newline at end of file
@@ -0,0 +1,140 @@
+from locking import CountingLock
+from metrics import metrics
+from schema import *
+from table_output import row_builders
+
+# The dedup of load_into_csv in threads mode, shared by all the chunk threads (benchmarks.bench_stages times the same
+# code). collect_tweet only collects (key, row builder arguments) candidates in thread local lists, CsvDedup.reconcile
+# checks them against the shared registries once per batch, so the locks are taken a few times per batch instead of
+# per entity.
+
+
+def new_candidates() -> dict[str, list]:
+    return {"users": [], "places": [], "tweets": [], "hashtags": [], "urls": [], "media": [], "user_mentions": []}
+
+
+def collect_tweet(candidates: dict[str, list], _tweet: Tweet):
+    # users, the sender and the mentioned users in the order they appear
+    sender = _tweet.user
+    candidates["users"].append((sender.id, sender, False))
+
+    # places
+    if _tweet.place:
+        candidates["places"].append((_tweet.place.id, (_tweet.place,)))
+
+    # tweets
+    candidates["tweets"].append((_tweet.id, (_tweet,)))
+
+    # hashtags, the ids are handed out in reconcile
+    if _tweet.entities and _tweet.entities.hashtags:
+        for h in _tweet.entities.hashtags:
+            tag: str = h.text.lower() or ''
+            candidates["hashtags"].append((_tweet.id, tag))
+
+    # urls
+    if _tweet.entities and _tweet.entities.urls:
+        for u in _tweet.entities.urls:
+            candidates["urls"].append(((int(_tweet.id), u.url or ''), (_tweet.id, u)))
+
+    # media
+    if _tweet.entities and _tweet.entities.media:
+        for m in _tweet.entities.media:
+            key = (int(_tweet.id), int(m.id) if m.id is not None else 0)
+            candidates["media"].append((key, (_tweet.id, m)))
+
+    # user mentions
+    if _tweet.entities and _tweet.entities.user_mentions:
+        for um in _tweet.entities.user_mentions:
+            candidates["user_mentions"].append(((um.id, _tweet.id), (_tweet.id, um)))
+            candidates["users"].append((um.id, um, True))
+
+    # nested tweets
+    if _tweet.quoted_status:
+        collect_tweet(candidates, _tweet.quoted_status)
+    if _tweet.retweeted_status:
+        collect_tweet(candidates, _tweet.retweeted_status)
+
+
+def reconcile(lock: CountingLock, registry, candidates: list[tuple], row_builder, rows: list, added_keys: list):
+    """Adds the keys of a whole batch under one lock, rows are only built for the keys nobody has seen yet."""
+    new_candidates = []
+    with lock:
+        for key, args in candidates:
+            if key not in registry:
+                registry.add(key)
+                added_keys.append(key)
+                new_candidates.append(args)
+    rows.extend(row_builder(*args) for args in new_candidates)
+    metrics.inc("rows_emitted_total", len(new_candidates), table=lock.name)
+    metrics.inc("dedup_hits_total", len(candidates) - len(new_candidates), table=lock.name)
+    candidates.clear()
+
+
+class CsvDedup:
+    """The registries (keyed by output table, see compact_sets), the hashtag ids and the users only known from a
+    mention, with a lock each."""
+
+    def __init__(self, registries: dict):
+        self.registries = registries
+        self.locks = {name: CountingLock(name) for name in ["users", "missing_mentioned_users", "places", "tweets",
+                                                            "hashtags", "tweet_hashtag", "urls", "media",
+                                                            "user_mentions"]}
+        self.hashtags_map: dict[str, int] = dict()
+        self.next_hashtag_id = 1
+        self.missing_mentioned_users: set[int] = set()
+
+    def reconcile(self, candidates: dict[str, list], rows: dict[str, list]) -> dict:
+        """Builds the rows of the candidates nobody has seen yet into `rows` (per output table) and empties the
+        candidate lists. Returns what the batch added to the shared state, load_into_csv checkpoints it."""
+        registries, locks = self.registries, self.locks
+        added = {"users": [], "places": [], "tweets": [], "tweet_hashtag": [], "urls": [], "media": [],
+                 "user_mentions": [], "hashtags": {}, "missing_added": [], "missing_removed": []}
+        users_set, missing_users = registries["users"], self.missing_mentioned_users
+        user_candidates = candidates["users"]
+        new_users = []
+        with locks["users"], locks["missing_mentioned_users"]:
+            for user_id, user, mentioned in user_candidates:
+                if not mentioned and user_id in missing_users:
+                    missing_users.remove(user_id)
+                    added["missing_removed"].append(user_id)
+                if user_id not in users_set:
+                    if mentioned:
+                        missing_users.add(user_id)
+                        added["missing_added"].append(user_id)
+                    users_set.add(user_id)
+                    added["users"].append(user_id)
+                    new_users.append((user, mentioned))
+        metrics.inc("rows_emitted_total", len(new_users), table="users")
+        metrics.inc("dedup_hits_total", len(user_candidates) - len(new_users), table="users")
+        rows["users"].extend(row_builders.mentioned_user_row(user) if mentioned else row_builders.user_row(user)
+                             for user, mentioned in new_users)
+        user_candidates.clear()
+
+        reconcile(locks["places"], registries["places"], candidates["places"], row_builders.place_row,
+                  rows["places"], added["places"])
+        reconcile(locks["tweets"], registries["tweets"], candidates["tweets"], row_builders.tweet_row,
+                  rows["tweets"], added["tweets"])
+
+        tweet_hashtag_candidates = []
+        with locks["hashtags"]:
+            for tweet_id, tag in candidates["hashtags"]:
+                hashtag_id = self.hashtags_map.get(tag)
+                if hashtag_id is None:
+                    hashtag_id = self.next_hashtag_id
+                    self.hashtags_map[tag] = hashtag_id
+                    self.next_hashtag_id += 1
+                # every tag the batch uses, the one that created it may be a chunk that has to be redone
+                added["hashtags"][tag] = hashtag_id
+                tweet_hashtag_candidates.append(((tweet_id, tag), (tweet_id, hashtag_id)))
+        candidates["hashtags"].clear()
+        reconcile(locks["tweet_hashtag"], registries["tweet_hashtag"], tweet_hashtag_candidates,
+                  row_builders.tweet_hashtag_row, rows["tweet_hashtag"], added["tweet_hashtag"])
+
+        reconcile(locks["urls"], registries["urls"], candidates["urls"], row_builders.url_row, rows["urls"],
+                  added["urls"])
+        reconcile(locks["media"], registries["media"], candidates["media"], row_builders.media_row, rows["media"],
+                  added["media"])
+        # keyed by (mentioned user, tweet) like before
+        reconcile(locks["user_mentions"], registries["user_mentions"], candidates["user_mentions"],
+                  row_builders.user_mention_row, rows["user_mentions"], added["user_mentions"])
+        return added
@@ -0,0 +1,99 @@
+from schema import *
+
+# order in which load_into_csv writes and merges the per-table csv files
+TABLES = ["users", "places", "tweets", "tweet_hashtag", "urls", "media", "user_mentions"]
+
+
+def user_row(user: User) -> list[str]:
+    return [
+        str(user.id),
+        f'"{user.screen_name or ""}"',
+        f'"{user.name or ""}"',
+        "C",#user.description or '',
+        str(user.verified) if user.verified is not None else '',
+        str(user.protected) if user.protected is not None else '',
+        str(user.followers_count) if user.followers_count is not None else '',
+        str(user.friends_count) if user.friends_count is not None else '',
+        str(user.statuses_count) if user.statuses_count is not None else '',
+        to_iso_format(user.created_at) if user.created_at else '',
+        f'"{user.location or ""}"',
+        f'"{user.url or ""}"'
+    ]
+
+
+# users that are only known from a mention, we don't have anything but id and names
+def mentioned_user_row(user_mention: UserMention) -> list[str]:
+    return [
+        str(user_mention.id) if user_mention.id is not None else '',
+        user_mention.screen_name or '',
+        user_mention.name or '',
+        '', '', '', '0', '0', '0', '', '', ''
+    ]
+
+
+def place_row(place: Place) -> list[str]:
+    return [
+        place.id or '',
+        f'"{place.full_name or ""}"',
+        f'"{place.country or ""}"',
+        f'"{place.country_code or ""}"',
+        f'"{place.place_type or ""}"'
+    ]
+
+
+def tweet_row(tweet: Tweet) -> list[str]:
+    return [
+        str(tweet.id),
+        to_iso_format(tweet.created_at) if tweet.created_at else '',
+        'B', #tweet.full_text or '',
+        str(tweet.display_text_range[0]) or '',
+        str(tweet.display_text_range[1]) or '',
+        f'"{tweet.lang or ""}"',
+        str(tweet.user.id) if tweet.user else '',
+        f'"{tweet.source or ""}"',
+        str(tweet.in_reply_to_status_id) if tweet.in_reply_to_status_id is not None else '',
+        str(tweet.quoted_status_id) if tweet.quoted_status_id is not None else '',
+        str(tweet.retweeted_status.id) if tweet.retweeted_status is not None else '',
+        tweet.place.id if tweet.place else '',
+        str(tweet.retweet_count) if tweet.retweet_count is not None else '',
+        str(tweet.favorite_count) if tweet.favorite_count is not None else '',
+        str(tweet.possibly_sensitive) if tweet.possibly_sensitive is not None else ''
+    ]
+
+
+def tweet_hashtag_row(tweet_id: int, hashtag_id: int) -> list[str]:
+    return [
+        str(tweet_id),
+        str(hashtag_id)
+    ]
+
+
+def url_row(tweet_id: int, url: Url) -> list[str]:
+    return [
+        str(tweet_id),
+        f'"{url.url or ""}"',
+        f'"{url.expanded_url or ""}"',
+        f'"{url.display_url or ""}"',
+        f'"{url.unwound_url or ""}"'
+    ]
+
+
+def media_row(tweet_id: int, media: Media) -> list[str]:
+    return [
+        str(tweet_id),
+        str(media.id) if media.id is not None else '',
+        f'"{media.type or ""}"',
+        f'"{media.media_url or ""}"',
+        f'"{media.media_url_https or ""}"',
+        f'"{media.display_url or ""}"',
+        f'"{media.expanded_url or ""}"'
+    ]
+
+
+def user_mention_row(tweet_id: int, user_mention: UserMention) -> list[str]:
+    return [
+        str(tweet_id),
+        str(user_mention.id) if user_mention.id is not None else '',
+        f'"{user_mention.screen_name or ""}"',
+        f'"{user_mention.name or ""}"'
+    ]
@@ -0,0 +1,95 @@
+import os
+import threading
+from collections import deque
+from psycopg2.extras import execute_values
+from utils import *
+
+# Process wide tag -> id cache for the hashtags table. Known tags are resolved without touching the server, new tags
+# get their ids from a block reserved from hashtags_id_seq up front and are the only ones written to hashtags.
+#
+# New tags are written and committed right away on the cache's own connection, so the ids it hands out always point
+# at existing rows, even if the worker's transaction with the tweet_hashtag links is rolled back and retried later.
+
+HASHTAG_CACHE = os.getenv("HASHTAG_CACHE", "1") == "1"
+HASHTAG_ID_BLOCK = int(os.getenv("HASHTAG_ID_BLOCK", 1000))
+
+
+class HashtagCache:
+    def __init__(self, connect=get_connection, block_size: int = HASHTAG_ID_BLOCK):
+        self._connect = connect
+        self._conn = None
+        self.block_size = block_size
+        self._ids: dict[str, int] = {}
+        self._reserved: deque[int] = deque()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cursor(self):
+        if self._conn is None:
+            self._conn = self._connect()
+        return self._conn.cursor()
+
+    def preload(self):
+        """Loads every existing tag, call once before the workers start."""
+        with self._lock, self._cursor() as cursor:
+            cursor.execute("SELECT id, tag FROM hashtags")
+            self._ids.update((tag, hashtag_id) for hashtag_id, tag in cursor.fetchall())
+            self._conn.commit()
+
+    def _reserve(self, cursor, count: int):
+        cursor.execute("SELECT nextval('hashtags_id_seq') FROM generate_series(1, %s)", (max(count, self.block_size),))
+        self._reserved.extend(hashtag_id for hashtag_id, in cursor.fetchall())
+
+    def _create(self, tags: list[str]):
+        with self._cursor() as cursor:
+            if len(self._reserved) < len(tags):
+                self._reserve(cursor, len(tags) - len(self._reserved))
+            new_ids = {tag: self._reserved.popleft() for tag in tags}
+            inserted = execute_values(cursor, "INSERT INTO hashtags (id, tag) VALUES %s ON CONFLICT (tag) DO NOTHING RETURNING tag",
+                                      list((hashtag_id, tag) for tag, hashtag_id in new_ids.items()), fetch=True)
+            inserted = {tag for tag, in inserted}
+            # somebody else (another process) was faster, use their id, ours is just a gap in the sequence
+            lost = [tag for tag in tags if tag not in inserted]
+            if lost:
+                cursor.execute("SELECT id, tag FROM hashtags WHERE tag IN %s", (tuple(lost),))
+                new_ids.update((tag, hashtag_id) for hashtag_id, tag in cursor.fetchall())
+            self._conn.commit()
+        self._ids.update(new_ids)
+
+    def ids_for(self, tags) -> dict[str, int]:
+        tags = set(tags)
+        missing = [tag for tag in tags if tag not in self._ids]
+        with self._lock:
+            if missing:
+                # another thread could have created them while we waited for the lock
+                missing = [tag for tag in missing if tag not in self._ids]
+                if missing:
+                    try:
+                        self._create(missing)
+                    except Exception:
+                        self._conn.rollback()
+                        raise
+            # shared by all upload workers, += isn't atomic
+            self.misses += len(missing)
+            self.hits += len(tags) - len(missing)
+        return {tag: self._ids[tag] for tag in tags}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+hashtag_cache = HashtagCache()
+
+
+def insert_hashtags_cached(cursor, tweet_hashtags: list[tuple[int, Hashtag]]):
+    """insert_hashtags_and_link, but the tag ids come from hashtag_cache and only the links are written here."""
+    tag_ids = hashtag_cache.ids_for(h.text for _, h in tweet_hashtags)
+    links = list({(tweet_id, tag_ids[h.text]) for tweet_id, h in tweet_hashtags})
+    if links:
+        execute_values(cursor, "INSERT INTO tweet_hashtag (tweet_id, hashtag_id) VALUES %s ON CONFLICT DO NOTHING", links)
+
+
+insert_hashtags = insert_hashtags_cached if HASHTAG_CACHE else insert_hashtags_and_link
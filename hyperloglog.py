@@ -0,0 +1,77 @@
+import math
+import os
+from hashlib import blake2b
+
+# HyperLogLog cardinality sketches for counting.py --approx. A sketch has 2**precision one byte registers, every key
+# goes to one register by the top bits of its 64 bit hash and the register keeps the longest run of leading zeros seen
+# in the rest. Two sketches merge by taking the register wise maximum, so every worker fills its own sketches without
+# any locks and they are combined at the end. The relative standard error is 1.04 / sqrt(2**precision), 1.6% for the
+# default 12 (4 KB per sketch).
+
+APPROX_PRECISION = int(os.getenv("APPROX_PRECISION", 12))
+
+_MASK64 = 2 ** 64 - 1
+
+
+def _mix64(value: int) -> int:
+    # splitmix64 finalizer, sequential ids end up spread over all registers
+    value = (value + 0x9E3779B97F4A7C15) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+
+def hash64(value) -> int:
+    if isinstance(value, int):
+        return _mix64(value & _MASK64)
+    if isinstance(value, str):
+        return int.from_bytes(blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+    if isinstance(value, tuple):
+        result = 0
+        for item in value:
+            result = _mix64(result ^ hash64(item))
+        return result
+    if value is None:
+        return hash64('\x00None')
+    raise TypeError(f"Can't hash {type(value).__name__} for a HyperLogLog sketch")
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = APPROX_PRECISION):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision has to be between 4 and 18")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self._shift = 64 - precision
+        self._rest_mask = (1 << self._shift) - 1
+
+    def add(self, value):
+        h = hash64(value)
+        index = h >> self._shift
+        # position of the first 1 bit in the remaining bits, all zeros count as one past the end
+        rank = self._shift - (h & self._rest_mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError("Only sketches with the same precision can be merged")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = len(self.registers)
+        # the bias correction of the paper, the formula only holds from 128 registers on
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m) or 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more precise while many registers are still empty
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def relative_error(self) -> float:
+        """One standard error, relative to the count."""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def nbytes(self) -> int:
+        return len(self.registers)
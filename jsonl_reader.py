@@ -0,0 +1,196 @@
+import bz2
+import gzip
+import lzma
+import mmap
+import os
+import queue
+import threading
+from typing import Iterator, NamedTuple
+
+try:
+    import zstandard
+except ImportError:  # only needed for .zst input
+    zstandard = None
+
+# files bigger than this are split into several tasks so one huge dump doesn't keep a single worker busy
+CHUNK_SIZE = int(float(os.getenv("CHUNK_MB", 256)) * 1024 * 1024)
+# compressed input is decompressed in a background thread, this many blocks of this size are read ahead
+DECOMPRESS_BLOCK_SIZE = int(os.getenv("DECOMPRESS_BLOCK_KB", 1024)) * 1024
+DECOMPRESS_QUEUE_DEPTH = int(os.getenv("DECOMPRESS_QUEUE_DEPTH", 8))
+
+
+def _open_zstd(path: str):
+    if zstandard is None:
+        raise ImportError(f"reading {path} needs the zstandard package")
+    return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+
+COMPRESSED_SUFFIXES = {
+    ".gz": lambda path: gzip.open(path, 'rb'),
+    ".bz2": lambda path: bz2.open(path, 'rb'),
+    ".xz": lambda path: lzma.open(path, 'rb'),
+    ".zst": _open_zstd,
+}
+
+
+class Chunk(NamedTuple):
+    path: str
+    # compressed files can't be split, they are always a single chunk that covers the whole file, start is an offset
+    # into the decompressed data then (only used to resume) and end is the compressed size
+    start: int  # first byte, always at the beginning of a line
+    end: int  # one past the last byte, always right after a newline (or EOF)
+    index: int  # position of the chunk within its file
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
+
+def compression_of(path: str) -> str | None:
+    suffix = os.path.splitext(path)[1]
+    return suffix if suffix in COMPRESSED_SUFFIXES else None
+
+
+def strip_jsonl_suffix(file_name: str) -> str:
+    """fileA.jsonl.gz -> fileA"""
+    if compression_of(file_name):
+        file_name = os.path.splitext(file_name)[0]
+    return os.path.splitext(file_name)[0]
+
+
+def is_jsonl_file(file_name: str) -> bool:
+    if compression_of(file_name):
+        file_name = os.path.splitext(file_name)[0]
+    return file_name.endswith(".jsonl")
+
+
+def list_jsonl_files(data_dir: str = "data") -> list[str]:
+    return [os.path.join(data_dir, f) for f in os.listdir(data_dir) if is_jsonl_file(f)]
+
+
+def split_file(path: str, chunk_size: int = CHUNK_SIZE) -> list[Chunk]:
+    file_size = os.path.getsize(path)
+    if compression_of(path):
+        return [Chunk(path, 0, file_size, 0)]
+    chunks = []
+    start = 0
+    with open(path, 'rb') as f:
+        while start < file_size:
+            end = start + chunk_size
+            if end >= file_size:
+                end = file_size
+            else:
+                # move the boundary right after the next newline so no line is cut in half
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            chunks.append(Chunk(path, start, end, len(chunks)))
+            start = end
+    if not chunks:
+        chunks.append(Chunk(path, 0, 0, 0))
+    return chunks
+
+
+def plan_chunks(paths: list[str], chunk_size: int = CHUNK_SIZE) -> list[Chunk]:
+    """Splits all files into newline aligned chunks, largest first so the tail of the run is made of small tasks."""
+    chunks = [chunk for path in paths for chunk in split_file(path, chunk_size)]
+    chunks.sort(key=lambda chunk: chunk.size, reverse=True)
+    return chunks
+
+
+def _read_ahead(fileobj, stop: threading.Event) -> Iterator[bytes]:
+    """Reads (and so decompresses) `fileobj` in a background thread, zlib/bz2/lzma/zstd release the GIL meanwhile."""
+    blocks = queue.Queue(maxsize=DECOMPRESS_QUEUE_DEPTH)
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            while True:
+                block = fileobj.read(DECOMPRESS_BLOCK_SIZE)
+                if not put(block) or not block:
+                    return
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, name="decompress", daemon=True)
+    thread.start()
+    while True:
+        block = blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        if not block:
+            return
+        yield block
+
+
+def _iter_compressed(path: str, start: int = 0) -> Iterator[tuple[bytes, int]]:
+    """Lines of a compressed file with the decompressed offset after each of them, from offset `start` on."""
+    stop = threading.Event()
+    fileobj = COMPRESSED_SUFFIXES[compression_of(path)](path)
+    try:
+        position = 0
+        rest = b''
+        for block in _read_ahead(fileobj, stop):
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                position += len(line) + 1
+                if position > start:
+                    yield line + b'\n', position
+        if rest:
+            position += len(rest)
+            if position > start:
+                yield rest, position
+    finally:
+        stop.set()
+        fileobj.close()
+
+
+def _is_blank(line: bytes) -> bool:
+    # tweets start with '{', only lines starting with whitespace need the full check
+    return line[:1].isspace() and not line.strip()
+
+
+def _iter_mapped(path: str, start: int, end: int | None) -> Iterator[tuple[bytes, int]]:
+    size = os.path.getsize(path)
+    end = size if end is None else min(end, size)
+    if start >= end:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, "madvise"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        find = mm.find
+        position = start
+        while position < end:
+            newline = find(b'\n', position)
+            next_position = size if newline == -1 else newline + 1
+            yield mm[position:next_position], next_position
+            position = next_position
+
+
+def iter_raw_lines(path: str, start: int = 0, end: int | None = None) -> Iterator[tuple[bytes, int]]:
+    """Non blank lines as undecoded bytes, with the offset after each of them, for the bytes accepting decoders.
+
+    Plain files are memory mapped and sliced at the newlines, no text layer decoding and no per line read() calls.
+    Every slice is still a copy of its line, the decoders don't take memoryviews.
+    """
+    lines = _iter_compressed(path, start) if compression_of(path) else _iter_mapped(path, start, end)
+    try:
+        for line, position in lines:
+            if not _is_blank(line):
+                yield line, position
+    finally:
+        lines.close()
+
+
+def iter_records(path: str, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+    for line, _ in iter_raw_lines(path, start, end):
+        yield line
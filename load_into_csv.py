@@ -1,340 +1,289 @@
-import json
-import csv
 from time import time
 import concurrent.futures as cf
 import threading
+from locking import contention_report
+from contextlib import closing
 from schema import *
+from table_output import *
 import os
+import pickle
+import shutil
+import sharded_export
+from manifest import Manifest
+from metrics import metrics
+from jsonl_reader import *
+from compact_sets import *
+from typing import NamedTuple
+from tweet_decoder import decode_line
+from csv_dedup import CsvDedup, new_candidates, collect_tweet
 from logger import Logger
 
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", 10000))
 RETRY_LIMIT = int(os.getenv("RETRY_LIMIT", 3))
 WORKER_COUNT = int(os.getenv("WORKER_COUNT", 16))
+# "threads" shares the dedup sets between threads, "processes" runs the sharded export from sharded_export
+EXPORT_MODE = os.getenv("EXPORT_MODE", "threads")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", WORKER_COUNT))
+MANIFEST_PATH = os.getenv("MANIFEST_PATH", "output/manifest.json")
+CHECKPOINT_DIR = "output/checkpoints"
+data_dir = "data"
 
-log = Logger("csv_log.txt")
 
-data_dir = "data"
-jsonl_files = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if f.endswith(".jsonl")]
-
-users_set: set[int] = set()
-users_lock = threading.Lock()
-
-places_set: set[str] = set()
-places_lock = threading.Lock()
-
-tweets_set = set()
-tweets_lock = threading.Lock()
-
-hashtags_map: dict[str, int] = dict()
-curr_hashtag_id = 1
-hashtags_lock = threading.Lock()
-
-tweet_hashtags_set: set[tuple[int, int]] = set()
-tweet_hashtags_lock = threading.Lock()
-
-urls_set: set[tuple[int, str]] = set()
-urls_lock = threading.Lock()
-
-media_set: set[tuple[int, int]] = set()
-media_lock = threading.Lock()
-
-user_mentions_set: set[tuple[int, int]] = set()
-user_mentions_lock = threading.Lock()
-
-missing_mentioned_users_lock = threading.Lock()
-missing_mentioned_users_set: set[int] = set()
-
-def process_file(tweets_file_path, max_line: int|None = None):
-    def merge_entities(entities: dict, extended_entities: dict) -> dict:
-        if not extended_entities:
-            return entities or {}
-        if not entities:
-            return extended_entities or {}
-
-        merged = entities.copy()
-        for key, ext_val in extended_entities.items():
-            ent_val = merged.get(key)
-            if isinstance(ext_val, list):
-                # Merge lists, unique by 'id' if present
-                seen_media_ids = set()
-                merged_list = []
-                for item in (ent_val or []) + ext_val:
-                    item_id = item.get('id') if isinstance(item, dict) else None
-                    if item_id is not None:
-                        if item_id not in seen_media_ids:
-                            seen_media_ids.add(item_id)
-                            merged_list.append(item)
-                    else:
-                        merged_list.append(item)
-                merged[key] = merged_list
-            else:
-                merged[key] = ext_val
-        return merged
-
-    def parse_tweet(_tweet: Tweet):
-        nonlocal users, places, tweets, hashtags_list, urls, media, user_mentions
-        global curr_hashtag_id
-        # users
-        sender = _tweet.user
-        with users_lock, missing_mentioned_users_lock:
-            if sender.id in missing_mentioned_users_set:
-                missing_mentioned_users_set.remove(sender.id)
-            if sender.id in users_set:
-                pass
-            else:
-                users_set.add(sender.id)
-                users.append([
-                    str(sender.id),
-                    f'"{sender.screen_name or ""}"',
-                    f'"{sender.name or ""}"',
-                    "C",#sender.description or '',
-                    str(sender.verified) if sender.verified is not None else '',
-                    str(sender.protected) if sender.protected is not None else '',
-                    str(sender.followers_count) if sender.followers_count is not None else '',
-                    str(sender.friends_count) if sender.friends_count is not None else '',
-                    str(sender.statuses_count) if sender.statuses_count is not None else '',
-                    to_iso_format(sender.created_at) if sender.created_at else '',
-                    f'"{sender.location or ""}"',
-                    f'"{sender.url or ""}"'
-                ])
-
-        # places
-        if _tweet.place:
-            with places_lock:
-                if _tweet.place.id in places_set:
-                    pass
-                else:
-                    places_set.add(_tweet.place.id)
-                    places.append([
-                        _tweet.place.id or '',
-                        f'"{_tweet.place.full_name or ""}"',
-                        f'"{_tweet.place.country or ""}"',
-                        f'"{_tweet.place.country_code or ""}"',
-                        f'"{_tweet.place.place_type or ""}"'
-                    ])
-
-        # tweets
-        with tweets_lock:
-            if _tweet.id in tweets_set:
-                pass
-            else:
-                tweets_set.add(_tweet.id)
-                tweets.append([
-                    str(_tweet.id),
-                    to_iso_format(_tweet.created_at) if _tweet.created_at else '',
-                    'B', #_tweet.full_text or '',
-                    str(_tweet.display_text_range[0]) or '',
-                    str(_tweet.display_text_range[1]) or '',
-                    f'"{_tweet.lang or ""}"',
-                    str(_tweet.user.id) if _tweet.user else '',
-                    f'"{_tweet.source or ""}"',
-                    str(_tweet.in_reply_to_status_id) if _tweet.in_reply_to_status_id is not None else '',
-                    str(_tweet.quoted_status_id) if _tweet.quoted_status_id is not None else '',
-                    str(_tweet.retweeted_status.id) if _tweet.retweeted_status is not None else '',
-                    _tweet.place.id if _tweet.place else '',
-                    str(_tweet.retweet_count) if _tweet.retweet_count is not None else '',
-                    str(_tweet.favorite_count) if _tweet.favorite_count is not None else '',
-                    str(_tweet.possibly_sensitive) if _tweet.possibly_sensitive is not None else ''
-                ])
-
-        # hashtags
-        if _tweet.entities and _tweet.entities.hashtags:
-            for h in _tweet.entities.hashtags:
-                tag: str = h.text.lower() or ''
-                with hashtags_lock:
-                    if tag in hashtags_map:
-                        hashtag_id = hashtags_map[tag]
-                    else:
-                        hashtag_id = curr_hashtag_id
-                        hashtags_map[tag] = curr_hashtag_id
-                        curr_hashtag_id += 1
-                with tweet_hashtags_lock:
-                    if (_tweet.id, hashtag_id) in tweet_hashtags_set:
-                        pass
-                    else:
-                        tweet_hashtags_set.add((_tweet.id, hashtag_id))
-                        hashtags_list.append([
-                            str(_tweet.id),
-                            str(hashtag_id)
-                        ])
-
-        # urls
-        if _tweet.entities and _tweet.entities.urls:
-            for u in _tweet.entities.urls:
-                with urls_lock:
-                    key = (int(_tweet.id), u.url or '')
-                    if key in urls_set:
-                        pass
-                    else:
-                        urls_set.add(key)
-                        urls.append([
-                            str(_tweet.id),
-                            f'"{u.url or ""}"',
-                            f'"{u.expanded_url or ""}"',
-                            f'"{u.display_url or ""}"',
-                            f'"{u.unwound_url or ""}"'
-                        ])
-
-        # media
-        if _tweet.entities and _tweet.entities.media:
-            for m in _tweet.entities.media:
-                with media_lock:
-                    key = (int(_tweet.id), int(m.id) if m.id is not None else 0)
-                    if key in media_set:
-                        pass
-                    else:
-                        media_set.add(key)
-                        media.append([
-                            str(_tweet.id),
-                            str(m.id) if m.id is not None else '',
-                            f'"{m.type or ""}"',
-                            f'"{m.media_url or ""}"',
-                            f'"{m.media_url_https or ""}"',
-                            f'"{m.display_url or ""}"',
-                            f'"{m.expanded_url or ""}"'
-                        ])
-
-        # user mentions
-        if _tweet.entities and _tweet.entities.user_mentions:
-            for um in _tweet.entities.user_mentions:
-                with user_mentions_lock:
-                    if (um.id, _tweet.id) in user_mentions_set:
-                        pass
-                    else:
-                        user_mentions_set.add((um.id, _tweet.id))
-                        user_mentions.append([
-                            str(_tweet.id),
-                            str(um.id) if um.id is not None else '',
-                            f'"{um.screen_name or ""}"',
-                            f'"{um.name or ""}"'
-                        ])
-                with users_lock, missing_mentioned_users_lock:
-                    if um.id in users_set:
-                        pass
-                    else:
-                        missing_mentioned_users_set.add(um.id)
-                        users_set.add(um.id)
-                        users.append([
-                            str(um.id) if um.id is not None else '',
-                            um.screen_name or '',
-                            um.name or '',
-                            '', '', '', '0', '0', '0', '', '', ''
-                        ])
-
-        # nested tweets
-        if _tweet.quoted_status:
-            parse_tweet(_tweet.quoted_status)
-        if _tweet.retweeted_status:
-            parse_tweet(_tweet.retweeted_status)
-
-    users: list[list[str]] = []
-    places: list[list[str]] = []
-    tweets: list[list[str]] = []
-    hashtags_list: list[list[str]] = []
-    urls: list[list[str]] = []
-    media: list[list[str]] = []
-    user_mentions: list[list[str]] = []
+def csv_base_name(file_path: str) -> str:
+    base_name = os.path.basename(file_path)[29:]
+    return strip_jsonl_suffix(base_name)
+
+
+def chunk_csv_name(chunk: Chunk) -> str:
+    return f"{csv_base_name(chunk.path)}_{chunk.index}"
+
+
+def checkpoint_path(chunk: Chunk) -> str:
+    return os.path.join(CHECKPOINT_DIR, f"{chunk_csv_name(chunk)}.pkl")
+
+
+class Export(NamedTuple):
+    """What one export works with. Only set up in the main process (setup_export), the workers of EXPORT_MODE=processes
+    import this module again under spawn/forkserver and get what they need as arguments."""
+    log: Logger
+    chunks: list[Chunk]  # biggest first, that's how they are scheduled
+    ordered_chunks: list[Chunk]  # in input order, the csv files are merged in this order
+    # Finished chunks are recorded in the manifest, a restart after a crash only redoes the others. In threads mode
+    # every chunk also pickles what it added to the shared dedup state (one record per batch) into its checkpoint
+    # file, so the state of the finished chunks can be restored without parsing them again.
+    manifest: Manifest
+    registries: dict  # keyed by table, see csv_dedup
+    dedup: CsvDedup
+
+
+def setup_export() -> Export:
+    log = Logger("csv_log.txt")
+    jsonl_files = list_jsonl_files(data_dir)
+    # big files are split into several chunks
+    chunks = plan_chunks(jsonl_files)
+    ordered_chunks = sorted(chunks, key=lambda c: (jsonl_files.index(c.path), c.index))
+    # tweet_hashtag keyed by tag rather than hashtag id, the ids are only valid within one run but the checkpoints
+    # are reused by a resumed one
+    registries = {"users": new_id_set("users"), "places": new_id_set("places"), "tweets": new_id_set("tweets"),
+                  "tweet_hashtag": new_pair_set("tweet_hashtag"), "urls": new_pair_set("urls"),
+                  "media": new_pair_set("media"), "user_mentions": new_pair_set("user_mentions")}
+    return Export(log, chunks, ordered_chunks, Manifest(MANIFEST_PATH), registries, CsvDedup(registries))
+
+
+# the candidates of a batch are collected in thread local lists and reconciled with the shared dedup state once per
+# batch, see csv_dedup
+def process_file(export: Export, chunk: Chunk, max_line: int|None = None):
+    tweets_file_path = chunk.path
+    log, dedup = export.log, export.dedup
+
+    def reconcile_candidates():
+        pickle.dump(dedup.reconcile(candidates, shard_writer.rows), checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    candidates = new_candidates()
+
+    # the row lists are the writer's buffers, it writes them out once they hold FLUSH_ROWS rows or MAX_BUFFER_MB
+    shard_writer = ShardWriter(chunk_csv_name(chunk), TABLES)
 
     time_before = time()
 
     base_name = os.path.basename(tweets_file_path)[29:]
-    base_file_name = os.path.splitext(base_name)[0]
+    complete = False
     line_count = 0
+    checkpoint_file = open(checkpoint_path(chunk), 'wb')
     try:
-        with open(tweets_file_path, 'r') as file:
+        with closing(iter_records(chunk.path, chunk.start, chunk.end)) as file:
             for line in file:
-                if not line.strip():
-                    continue
-
                 line_count += 1
 
                 if max_line and line_count > max_line:
                     break
 
-                tweet_json = json.loads(line)
-
-                if 'extended_entities' in tweet_json:
-                    tweet_json['entities'] = merge_entities(tweet_json.get('entities', {}), tweet_json['extended_entities'])
-
                 try:
-                    tweet = Tweet.model_validate(tweet_json)
-                    parse_tweet(tweet)
+                    tweet = decode_line(line)
+                    collect_tweet(candidates, tweet)
                 except Exception as e:
                     log.error(f"Error parsing tweet JSON: {e}")
+                    metrics.inc("parse_failures_total")
                     break
 
-            if line_count % BATCH_SIZE == 0:
-                tables = [ ("users", users), ("places", places), ("tweets", tweets), ("tweet_hashtag", hashtags_list), ("urls", urls), ("media", media), ("user_mentions", user_mentions) ]
-                for table_name, table_content in tables:
-                    with open(f"output/{base_file_name}_{table_name}.csv", 'a', newline='', encoding='utf-8') as f:
-                        writer = csv.writer(f)
-                        writer.writerows(table_content)
-                        log.info(f"Wrote to {base_file_name}_{table_name}.csv")
-                # clean up
-                for _, table_content in tables:
-                    table_content.clear()
-
-        # insert the remainder
-        tables = [("users", users), ("places", places), ("tweets", tweets), ("tweet_hashtag", hashtags_list), ("urls", urls),
-                  ("media", media), ("user_mentions", user_mentions)]
-        for table_name, table_content in tables:
-            with open(f"output/{base_file_name}_{table_name}.csv", 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerows(table_content)
+                if line_count % BATCH_SIZE == 0:
+                    metrics.inc("lines_read_total", BATCH_SIZE)
+                    reconcile_candidates()
+                    shard_writer.flush_if_full()
+            else:
+                complete = True
+
+        # write the remainder
+        reconcile_candidates()
+        shard_writer.close()
+        checkpoint_file.close()
+        if complete:
+            export.manifest.record(chunk, chunk.end, line_count // BATCH_SIZE + 1, done=True)
 
     except Exception as e:
         log.error(f"Error processing file {tweets_file_path}: {e}")
         return
 
     finally:
+        shard_writer.close()
+        checkpoint_file.close()
+        metrics.inc("lines_read_total", line_count % BATCH_SIZE)
         time_after = time()
-        log.info(f"Processed {line_count-1} tweets from {base_name} in {time_after - time_before:.2f} seconds.")
+        log.info(f"Processed {line_count-1} tweets from {base_name} [{chunk.start}:{chunk.end}] in {time_after - time_before:.2f} seconds.")
+
+
+def process_files_sharded(export: Export, shard_count: int) -> dict[str, int]:
+    """Multi-process export, see sharded_export. Fills the hashtags and the missing mentioned users of export.dedup
+    and returns the unique counts per table."""
+    log, manifest, chunks = export.log, export.manifest, export.chunks
+    # spill files are kept until the export is through, a restart only maps the chunks that didn't finish
+    spill_dir = f"output/spill_{shard_count}"
+    os.makedirs(spill_dir, exist_ok=True)
+    unique_counts = {"users": 0, "places": 0, "tweets": 0, "urls": 0, "media": 0, "user_mentions": 0}
+
+    def is_mapped(chunk: Chunk) -> bool:
+        return manifest.is_done(chunk) and all(
+            os.path.exists(sharded_export.spill_path(spill_dir, chunk_csv_name(chunk), shard)) for shard in range(shard_count))
+
+    pending_chunks = [chunk for chunk in chunks if not is_mapped(chunk)]
+    if len(pending_chunks) < len(chunks):
+        log.info(f"Skipping {len(chunks) - len(pending_chunks)} chunks mapped by an earlier run.")
+
+    with cf.ProcessPoolExecutor(max_workers=WORKER_COUNT) as executor:
+        # the reduce phase reads the spill files in input order so it sees the tweets in the same order as a single
+        # threaded run would, but the chunks are still submitted biggest first
+        futures = {executor.submit(sharded_export.map_file, chunk, chunk_csv_name(chunk), shard_count, spill_dir): chunk
+                   for chunk in pending_chunks}
+        for future in cf.as_completed(futures):
+            chunk = futures[future]
+            try:
+                line_count, seconds, error = future.result()
+                metrics.inc("lines_read_total", line_count)
+                if error:
+                    log.error(error)
+                    metrics.inc("parse_failures_total")
+                else:
+                    manifest.record(chunk, chunk.end, line_count // BATCH_SIZE + 1, done=True)
+                log.info(f"Processed {line_count} tweets from {os.path.basename(chunk.path)} [{chunk.start}:{chunk.end}] in {seconds:.2f} seconds.")
+            except Exception as e:
+                log.error(f"Error processing file {chunk.path}: {e}")
+
+        spill_names = [chunk_csv_name(chunk) for chunk in export.ordered_chunks]
+        futures = [executor.submit(sharded_export.reduce_shard, shard, shard_count, spill_names, spill_dir)
+                   for shard in range(shard_count)]
+        for future in cf.as_completed(futures):
+            shard_hashtags, shard_missing_users, shard_counts = future.result()
+            export.dedup.hashtags_map.update(shard_hashtags)
+            export.dedup.missing_mentioned_users.update(shard_missing_users)
+            for table, count in shard_counts.items():
+                unique_counts[table] += count
+                metrics.inc("rows_emitted_total", count, table=table)
+
+    shutil.rmtree(spill_dir)
+    return unique_counts
+
+
+def restore_checkpoints(dedup: CsvDedup, done_chunks: list[Chunk]):
+    """Puts what the finished chunks added back into the shared dedup state."""
+    hashtags_map, missing_mentioned_users_set = dedup.hashtags_map, dedup.missing_mentioned_users
+    missing_removed = set()
+    for chunk in done_chunks:
+        with open(checkpoint_path(chunk), 'rb') as checkpoint_file:
+            while True:
+                try:
+                    added = pickle.load(checkpoint_file)
+                except EOFError:
+                    break
+                for name, registry in dedup.registries.items():
+                    for key in added[name]:
+                        registry.add(key)
+                hashtags_map.update(added["hashtags"])
+                missing_mentioned_users_set.update(added["missing_added"])
+                missing_removed.update(added["missing_removed"])
+    # a user that was a sender somewhere is never added back, so the order of the chunks doesn't matter here
+    missing_mentioned_users_set.difference_update(missing_removed)
+    dedup.next_hashtag_id = max(hashtags_map.values(), default=0) + 1
+
+
+def main():
+    export = setup_export()
+    log, manifest, chunks, ordered_chunks, registries = \
+        export.log, export.manifest, export.chunks, export.ordered_chunks, export.registries
+    hashtags_map, missing_mentioned_users_set = export.dedup.hashtags_map, export.dedup.missing_mentioned_users
+    if manifest.finished and all(manifest.is_done(chunk) for chunk in chunks):
+        log.info(f"All chunks were already exported by an earlier run, nothing to do (RESUME=0 or removing {MANIFEST_PATH} starts over).")
+        return
+    if manifest.finished:
+        # the shard files of the last run are merged and gone already, so changed input means starting over
+        manifest.reset()
+
+    if EXPORT_MODE == "processes":
+        shard_names = [f"shard{shard}" for shard in range(SHARD_COUNT)]
+        done_chunks = []
+    else:
+        shard_names = [chunk_csv_name(chunk) for chunk in ordered_chunks]
+        done_chunks = [chunk for chunk in ordered_chunks
+                       if manifest.is_done(chunk) and os.path.exists(checkpoint_path(chunk))]
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+
+    # clean up the shard files first, except for the chunks an earlier run finished
+    for shard_name in set(shard_names) - {chunk_csv_name(chunk) for chunk in done_chunks}:
+        for table in TABLES:
+            shard_file_path = output_path(f"{shard_name}_{table}")
+            if os.path.exists(shard_file_path):
+                os.remove(shard_file_path)
+
+    metrics.start("load_into_csv")
+    total_time_before = time()
+    if EXPORT_MODE == "processes":
+        unique_counts = process_files_sharded(export, SHARD_COUNT)
+    else:
+        # unlike concurrent_uploading's seen_ids, these registries are scoped to one export on purpose: every export
+        # writes complete csv files, keys of an earlier export would leave rows out of them. A killed run may also have
+        # added keys of chunks it didn't finish, so they start empty and only get back what the finished chunks'
+        # checkpoints added
+        clear_registries(registries.values())
+        if done_chunks:
+            restore_checkpoints(export.dedup, done_chunks)
+            log.info(f"Skipping {len(done_chunks)} chunks finished by an earlier run.")
+        with cf.ThreadPoolExecutor(max_workers=WORKER_COUNT) as executor:
+            futures = [executor.submit(process_file, export, chunk) for chunk in chunks if chunk not in done_chunks]
+            for future in cf.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    log.error(f"Error in thread: {e}")
+        unique_counts = {table: len(registries[table])
+                         for table in ["users", "places", "tweets", "urls", "media", "user_mentions"]}
+        log.info("Lock contention: " + contention_report(list(export.dedup.locks.values())))
+        if DEDUP_BACKEND != "python":
+            log.info("Dedup memory: " + memory_report(registries))
+        close_registries(registries.values())
 
+    total_time_after = time()
+    log.info(f"All files processed in {total_time_after - total_time_before:.2f} seconds.")
+    log.info(f"Unique users: {unique_counts['users']}, places: {unique_counts['places']}, tweets: {unique_counts['tweets']}, hashtags: {len(hashtags_map)}, urls: {unique_counts['urls']}, media: {unique_counts['media']}, user_mentions: {unique_counts['user_mentions']}, incomplete users born from user_mentions: {len(missing_mentioned_users_set)}")
 
-# clean up the csv files first
-for file_path in jsonl_files:
-    base_name = os.path.basename(file_path)[29:]
-    base_file_name = os.path.splitext(base_name)[0]
-    for table in ["users", "places", "tweets", "tweet_hashtag", "urls", "media", "user_mentions"]:
-        csv_file_path = f"output/{base_file_name}_{table}.csv"
-        if os.path.exists(csv_file_path):
-            os.remove(csv_file_path)
-
-
-total_time_before = time()
-with cf.ThreadPoolExecutor(max_workers=WORKER_COUNT) as executor:
-    futures = [executor.submit(process_file, file_path) for file_path in jsonl_files]
-    for future in cf.as_completed(futures):
-        try:
-            future.result()
-        except Exception as e:
-            log.error(f"Error in thread: {e}")
-
-total_time_after = time()
-log.info(f"All files processed in {total_time_after - total_time_before:.2f} seconds.")
-log.info(f"Unique users: {len(users_set)}, places: {len(places_set)}, tweets: {len(tweets_set)}, hashtags: {len(hashtags_map)}, urls: {len(urls_set)}, media: {len(media_set)}, user_mentions: {len(user_mentions_set)}, incomplete users born from user_mentions: {len(missing_mentioned_users_set)}")
-
-# join all csv files into one for each table
-for table in ["users", "places", "tweets", "tweet_hashtag", "urls", "media", "user_mentions"]:
-    with open(f"output/{table}.csv", 'w', newline='', encoding='utf-8') as outfile:
-        for file_path in jsonl_files:
-            base_name = os.path.basename(file_path)[29:]
-            base_file_name = os.path.splitext(base_name)[0]
-            csv_file_path = f"output/{base_file_name}_{table}.csv"
-            if os.path.exists(csv_file_path):
-                with open(csv_file_path, 'r',  newline='', encoding='utf-8') as infile:
-                    file_content = infile.read()
-                    outfile.write(file_content)
-                os.remove(csv_file_path)  # remove the individual file after merging
-
-# keep track of users that weren't created fully (only id, screen_name, name) because they were only mentioned in tweets
-with open(f"output/temp_users.csv", 'w', newline='', encoding='utf-8') as temp_users:
-    writer = csv.writer(temp_users)
-    for user_id in missing_mentioned_users_set:
-        writer.writerow([user_id])
-
-# add all hashtags from hashtag set into hashtag.csv
-with open(f"output/hashtags.csv", 'w', newline='', encoding='utf-8') as hashtag_file:
-    writer = csv.writer(hashtag_file)
-    for hashtag in hashtags_map:
-        writer.writerow([hashtags_map[hashtag], hashtag])
+    # join all shard files into one for each table
+    if MERGE_MODE != "manifest":
+        for table in TABLES:
+            merge_shards(output_path(table), table, [output_path(f"{shard_name}_{table}") for shard_name in shard_names])
+
+    # keep track of users that weren't created fully (only id, screen_name, name) because they were only mentioned in tweets
+    write_table(output_path("temp_users"), "temp_users", ([user_id] for user_id in missing_mentioned_users_set))
+
+    # add all hashtags from hashtag set into hashtags.csv
+    write_table(output_path("hashtags"), "hashtags", ([hashtags_map[hashtag], hashtag] for hashtag in hashtags_map))
+
+    if MERGE_MODE == "manifest":
+        table_files = {table: [output_path(f"{shard_name}_{table}") for shard_name in shard_names] for table in TABLES}
+        table_files.update(temp_users=[output_path("temp_users")], hashtags=[output_path("hashtags")])
+        write_copy_manifest(os.path.join("output", COPY_MANIFEST), table_files)
+
+    metrics.stop()
+    manifest.finish()
+    shutil.rmtree(CHECKPOINT_DIR)
+
+
+if __name__ == "__main__":
+    main()
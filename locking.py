@@ -0,0 +1,34 @@
+import threading
+
+
+class CountingLock:
+    """threading.Lock that counts how often it was taken and how often a thread had to wait for it."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        contended = not self._lock.acquire(False)
+        if contended and not self._lock.acquire(blocking, timeout):
+            return False
+        # counters are only touched while holding the lock
+        self.acquisitions += 1
+        self.contended += contended
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def contention_report(locks: list[CountingLock]) -> str:
+    return ", ".join(f"{lock.name}: {lock.acquisitions} acquired, {lock.contended} contended" for lock in locks)
@@ -1,18 +1,127 @@
+import atexit
+import os
+import queue
+import re
+import sys
+import threading
+from datetime import datetime
+from time import monotonic
+
+# The worker threads only put their messages into a queue, a background thread writes them into one buffered file
+# handle (and to the console) and flushes once the queue is empty, instead of every call opening and closing the file.
+#
+# Repeated warnings (same text apart from the numbers, e.g. the retries' "retrying 2/3") and repeated errors (exactly
+# the same text, errors about different files stay apart) are written once per LOG_RATE_LIMIT seconds, the next one
+# that gets through says how many were left out in between.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", 5))
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+_NUMBERS = re.compile(r'\d+')
+_STOP = None
+
+
 class Logger:
-    def __init__(self, log_path: str = "log.txt"):
+    def __init__(self, log_path: str = "log.txt", level: str = LOG_LEVEL):
         self.log_path = log_path
-        # Clear the log file on initialization
-        with open(self.log_path, "w") as log_file:
-            log_file.write("")
+        self.level = LEVELS[level.upper()]
+        # opening with "w" clears the log file like before
+        self._file = open(self.log_path, "w", encoding="utf-8", buffering=64 * 1024)
+        self._inherited_files = []
+        self._start()
+        if hasattr(os, "register_at_fork"):  # unix only, there's no fork on windows
+            os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.close)
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._last_logged: dict[tuple[str, str], float] = {}
+        self._suppressed: dict[tuple[str, str], int] = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._write, name="logger", daemon=True)
+        self._thread.start()
+
+    def _after_fork(self):
+        # the child gets a copy of the parent's file buffer, flushing it would write the parent's pending lines twice,
+        # so it's kept around unflushed and the child appends through a handle of its own
+        self._inherited_files.append(self._file)
+        self._file = open(self.log_path, "a", encoding="utf-8", buffering=64 * 1024)
+        self._start()
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                line, console_line = item
+                self._file.write(line)
+                if console_line is not None:
+                    sys.stdout.write(console_line)
+                if self._queue.empty():
+                    self._file.flush()
+                    sys.stdout.flush()
+            except Exception:  # a broken log file must not take the loader down
+                pass
+            finally:
+                self._queue.task_done()
+
+    def _rate_limited(self, level: str, message: str) -> tuple[bool, int]:
+        """(skip the message, how many were skipped since the last one that got through)."""
+        if LEVELS[level] < LEVELS["WARNING"] or LOG_RATE_LIMIT <= 0:
+            return False, 0
+        key = (level, _NUMBERS.sub('#', message) if level == "WARNING" else message)
+        now = monotonic()
+        with self._lock:
+            last = self._last_logged.get(key)
+            if last is not None and now - last < LOG_RATE_LIMIT:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return True, 0
+            self._last_logged[key] = now
+            return False, self._suppressed.pop(key, 0)
+
+    def log(self, level: str, message: str, to_console: bool = True):
+        if LEVELS[level] < self.level or self._closed:
+            return
+        skip, suppressed = self._rate_limited(level, message)
+        if skip:
+            return
+        if suppressed:
+            message += f" ({suppressed} similar messages suppressed)"
+        self._enqueue(level, message, to_console)
+
+    def _enqueue(self, level: str, message: str, to_console: bool):
+        timestamp = datetime.now().isoformat(sep=' ', timespec='milliseconds')
+        self._queue.put((f"{timestamp} [{level}] {message}\n", f"[{level}] {message}\n" if to_console else None))
+
+    def debug(self, message: str, to_console: bool = False):
+        self.log("DEBUG", message, to_console)
 
     def info(self, message: str, to_console: bool = True):
-        if to_console:
-            print(f"[INFO] {message}")
-        with open(self.log_path, "a") as log_file:
-            log_file.write(f"[INFO] {message}\n")
+        self.log("INFO", message, to_console)
+
+    def warning(self, message: str, to_console: bool = True):
+        self.log("WARNING", message, to_console)
 
     def error(self, message: str, to_console: bool = True):
-        if to_console:
-            print(f"[ERROR] {message}")
-        with open(self.log_path, "a") as log_file:
-            log_file.write(f"[ERROR] {message}\n")
+        self.log("ERROR", message, to_console)
+
+    def flush(self):
+        """Blocks until everything logged so far is written."""
+        self._queue.join()
+        self._file.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        with self._lock:
+            left_out = dict(self._suppressed)
+            self._suppressed.clear()
+        for (level, template), count in left_out.items():
+            self._enqueue(level, f"{count} more messages like \"{template}\" suppressed", False)
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout=10)
+        self._file.close()
@@ -0,0 +1,77 @@
+import json
+import os
+import threading
+from jsonl_reader import Chunk
+
+# Progress of a run, per input chunk: how far it got (byte offset of the first line that isn't committed/written yet),
+# how many batches that was and whether the chunk is complete. Rewritten atomically (temp file + rename) on every
+# record, so after a crash it holds the state of the last commit or flush, never half of it.
+#
+# Entries remember size and mtime of their input file, a file that changed since is processed from scratch.
+
+RESUME = os.getenv("RESUME", "1") == "1"
+
+
+def _fingerprint(path: str) -> list[int]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class Manifest:
+    def __init__(self, path: str, resume: bool = RESUME):
+        self.path = path
+        self._lock = threading.Lock()
+        self.chunks: dict[str, dict] = {}
+        self.finished = False
+        if resume and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self.chunks = state["chunks"]
+            self.finished = state["finished"]
+
+    @staticmethod
+    def key(chunk: Chunk) -> str:
+        return f"{chunk.path}:{chunk.start}-{chunk.end}"
+
+    def entry(self, chunk: Chunk) -> dict | None:
+        entry = self.chunks.get(self.key(chunk))
+        if entry is None or entry["file"] != _fingerprint(chunk.path):
+            return None
+        return entry
+
+    def is_done(self, chunk: Chunk) -> bool:
+        entry = self.entry(chunk)
+        return entry is not None and entry["done"]
+
+    def resume_offset(self, chunk: Chunk) -> int:
+        entry = self.entry(chunk)
+        return entry["offset"] if entry else chunk.start
+
+    def batches(self, chunk: Chunk) -> int:
+        entry = self.entry(chunk)
+        return entry["batch"] if entry else 0
+
+    def record(self, chunk: Chunk, offset: int, batch: int, done: bool = False):
+        with self._lock:
+            self.chunks[self.key(chunk)] = {"file": _fingerprint(chunk.path), "offset": offset, "batch": batch,
+                                            "done": done}
+            self._write()
+
+    def finish(self):
+        with self._lock:
+            self.finished = True
+            self._write()
+
+    def reset(self):
+        with self._lock:
+            self.chunks = {}
+            self.finished = False
+            self._write()
+
+    def _write(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"finished": self.finished, "chunks": self.chunks}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from time import time, monotonic
+
+# Process wide ingest metrics: counters (lines read, parse failures, rows per table, dedup hits, retries), gauges
+# (queue depths) and latency histograms (batch commits, shard flushes). With METRICS_PATH set, a background thread
+# rewrites a snapshot every METRICS_INTERVAL seconds, as a Prometheus textfile (.prom, for node_exporter's textfile
+# collector) or as json (.json, with per second rates since the previous snapshot).
+#
+# Counters are bumped once per batch, not per line, the registry lock shouldn't show up next to the loaders' own.
+
+METRICS_PATH = os.getenv("METRICS_PATH", "")
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", 10))
+PREFIX = "pdt_"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name: str, labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return name
+    return name + "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: dict[tuple, float] = {}
+        self.gauges: dict[tuple, float] = {}
+        self.histograms: dict[tuple, list] = {}  # [bucket counts (one more for +Inf), sum, count]
+        self.job = None
+        self._started = monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_snapshot = None  # (time, counters) for the rates of the json snapshot
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect_left(BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def to_prometheus(self) -> str:
+        with self._lock:
+            counters, gauges = dict(self.counters), dict(self.gauges)
+            histograms = {key: [list(h[0]), h[1], h[2]] for key, h in self.histograms.items()}
+        job = (("script", self.job),) if self.job else ()
+        lines = []
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                lines.extend(f"{_series(PREFIX + name, job + labels)} {value}"
+                             for (n, labels), value in sorted(series.items()) if n == name)
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            for (n, labels), (buckets, total, count) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS + ("+Inf",), buckets):
+                    cumulative += bucket
+                    lines.append(f"{_series(PREFIX + name + '_bucket', job + labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{_series(PREFIX + name + '_sum', job + labels)} {total}")
+                lines.append(f"{_series(PREFIX + name + '_count', job + labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        now = monotonic()
+        with self._lock:
+            counters = {_series(name, labels): value for (name, labels), value in self.counters.items()}
+            gauges = {_series(name, labels): value for (name, labels), value in self.gauges.items()}
+            histograms = {_series(name, labels): {"buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], h[0])),
+                                                  "sum": h[1], "count": h[2]}
+                          for (name, labels), h in self.histograms.items()}
+        rates = {}
+        if self._last_snapshot:
+            last_time, last_counters = self._last_snapshot
+            rates = {series: (value - last_counters.get(series, 0)) / (now - last_time)
+                     for series, value in counters.items() if now > last_time}
+        self._last_snapshot = (now, counters)
+        return {"script": self.job, "timestamp": time(), "uptime_seconds": now - self._started, "counters": counters,
+                "rates_per_second": rates, "gauges": gauges, "histograms": histograms}
+
+    def write(self, path: str = METRICS_PATH):
+        """Replaces `path` atomically, so a scraper never reads half a file."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            if path.endswith(".json"):
+                json.dump(self.to_json(), f, indent=2)
+            else:
+                f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def start(self, job: str):
+        """Starts rewriting METRICS_PATH in the background, does nothing without it."""
+        self.job = job
+        if not METRICS_PATH or self._thread:
+            return
+        self._thread = threading.Thread(target=self._export, name="metrics", daemon=True)
+        self._thread.start()
+
+    def _export(self):
+        while not self._stop.wait(METRICS_INTERVAL):
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def stop(self):
+        """Writes the final snapshot."""
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.write()
+
+
+metrics = Metrics()
@@ -0,0 +1,107 @@
+import os
+from datetime import datetime
+from pgcopy import TABLE_LAYOUTS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for OUTPUT_FORMAT=parquet
+    pa = pq = None
+
+# Parquet output of load_into_csv and sharded_export (OUTPUT_FORMAT=parquet). Columns are typed after
+# sql_scripts/schema.sql (see pgcopy.TABLE_LAYOUTS) and compressed, so a scan of a few columns only reads those
+# column chunks instead of every quoted csv value. Every flush of a ShardWriter becomes one (small) row group of the
+# shard file, the merge rebatches them into row groups of PARQUET_BATCH_ROWS rows.
+
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+PARQUET_BATCH_ROWS = int(os.getenv("PARQUET_BATCH_ROWS", 100000))
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("OUTPUT_FORMAT=parquet needs the pyarrow package")
+
+
+def _arrow_type(column_type: str):
+    return {"bigint": pa.int64(), "int": pa.int32(), "text": pa.string(), "boolean": pa.bool_(),
+            "timestamp": pa.timestamp('us')}[column_type]
+
+
+def arrow_schema(table: str):
+    return pa.schema([(name, _arrow_type(column_type)) for name, column_type in TABLE_LAYOUTS[table]])
+
+
+def _timestamp(value: str | datetime | None) -> datetime | None:
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:  # same as the binary COPY output, NULL instead of a failed write
+            return None
+    # TIMESTAMP without time zone, the wall clock time like postgres keeps it
+    return value.replace(tzinfo=None) if value is not None else None
+
+
+def record_batch(table: str, rows: list[tuple]):
+    """Turns typed_rows tuples of `table` (a table of schema.sql) into a record batch."""
+    schema = arrow_schema(table)
+    columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in schema]
+    for i, (_, column_type) in enumerate(TABLE_LAYOUTS[table]):
+        if column_type == "timestamp":
+            columns[i] = [_timestamp(value) for value in columns[i]]
+    return pa.record_batch([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                           schema=schema)
+
+
+class ParquetShardWriter:
+    """One parquet file of `table`, every write_rows call adds a row group."""
+
+    def __init__(self, path: str, table: str):
+        require_pyarrow()
+        self.table = table
+        self._writer = pq.ParquetWriter(path, arrow_schema(table), compression=PARQUET_COMPRESSION)
+
+    def write_rows(self, rows: list[tuple]):
+        self._writer.write_batch(record_batch(self.table, rows))
+
+    def close(self):
+        self._writer.close()
+
+
+def write_parquet_file(path: str, table: str, rows):
+    writer = ParquetShardWriter(path, table)
+    batch = []
+    try:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= PARQUET_BATCH_ROWS:
+                writer.write_rows(batch)
+                batch.clear()
+        if batch:
+            writer.write_rows(batch)
+    finally:
+        writer.close()
+
+
+def merge_parquet_files(path: str, table: str, shard_paths: list[str]):
+    """Copies the rows of the shard files into one file, in row groups of PARQUET_BATCH_ROWS rows, and removes them.
+    Not much more than one row group is in memory at a time."""
+    require_pyarrow()
+    schema = arrow_schema(table)
+    writer = pq.ParquetWriter(path, schema, compression=PARQUET_COMPRESSION)
+    pending = pa.Table.from_batches([], schema=schema)  # rows that don't fill a row group yet
+    try:
+        for shard_path in shard_paths:
+            if os.path.exists(shard_path):
+                shard = pq.ParquetFile(shard_path)
+                for batch in shard.iter_batches(batch_size=PARQUET_BATCH_ROWS):
+                    pending = pa.concat_tables([pending, pa.Table.from_batches([batch], schema=schema)])
+                    full = pending.num_rows - pending.num_rows % PARQUET_BATCH_ROWS
+                    if full:
+                        writer.write_table(pending.slice(0, full), row_group_size=PARQUET_BATCH_ROWS)
+                        pending = pending.slice(full)
+                shard.close()
+                os.remove(shard_path)
+        if pending.num_rows:
+            writer.write_table(pending, row_group_size=PARQUET_BATCH_ROWS)
+    finally:
+        writer.close()
@@ -0,0 +1,123 @@
+import io
+import struct
+from datetime import datetime
+
+# Encoder for the binary COPY format (COPY ... WITH (FORMAT binary)). Values go over the wire in the server's
+# internal representation, so postgres doesn't parse any BIGINT/TIMESTAMP/BOOLEAN text and there is no quoting or
+# escaping at all.
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)  # signature, flags, header extension length
+PGCOPY_TRAILER = struct.pack('>h', -1)
+
+# column layouts of sql_scripts/schema.sql
+TABLE_LAYOUTS: dict[str, list[tuple[str, str]]] = {
+    "users": [("id", "bigint"), ("screen_name", "text"), ("name", "text"), ("description", "text"),
+              ("verified", "boolean"), ("protected", "boolean"), ("followers_count", "int"),
+              ("friends_count", "int"), ("statuses_count", "int"), ("created_at", "timestamp"),
+              ("location", "text"), ("url", "text")],
+    "temp_users": [("id", "bigint")],
+    "places": [("id", "text"), ("full_name", "text"), ("country", "text"), ("country_code", "text"),
+               ("place_type", "text")],
+    "tweets": [("id", "bigint"), ("created_at", "timestamp"), ("full_text", "text"), ("display_from", "int"),
+               ("display_to", "int"), ("lang", "text"), ("user_id", "bigint"), ("source", "text"),
+               ("in_reply_to_status_id", "bigint"), ("quoted_status_id", "bigint"),
+               ("retweeted_status_id", "bigint"), ("place_id", "text"), ("retweet_count", "int"),
+               ("favorite_count", "int"), ("possibly_sensitive", "boolean")],
+    "hashtags": [("id", "bigint"), ("tag", "text")],
+    "tweet_hashtag": [("tweet_id", "bigint"), ("hashtag_id", "bigint")],
+    "tweet_urls": [("tweet_id", "bigint"), ("url", "text"), ("expanded_url", "text"), ("display_url", "text"),
+                   ("unwound_url", "text")],
+    "tweet_user_mentions": [("tweet_id", "bigint"), ("mentioned_user_id", "bigint"),
+                            ("mentioned_screen_name", "text"), ("mentioned_name", "text")],
+    # staging table of concurrent_uploading, same columns as tweet_user_mentions
+    "temp_tweet_user_mentions": [("tweet_id", "bigint"), ("mentioned_user_id", "bigint"),
+                                 ("mentioned_screen_name", "text"), ("mentioned_name", "text")],
+    "tweet_media": [("tweet_id", "bigint"), ("media_id", "bigint"), ("type", "text"), ("media_url", "text"),
+                    ("media_url_https", "text"), ("display_url", "text"), ("expanded_url", "text")],
+}
+
+_NULL = struct.pack('>i', -1)
+_BIGINT = struct.Struct('>iq')  # field length + value
+_INT = struct.Struct('>ii')
+_BOOLEAN = {True: struct.pack('>i?', 1, True), False: struct.pack('>i?', 1, False)}
+_POSTGRES_EPOCH = datetime(2000, 1, 1)
+
+
+def _timestamp_micros(value: str | datetime) -> int | None:
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:  # to_iso_format hands back what it couldn't parse, better NULL than a failed COPY
+            return None
+    # TIMESTAMP without time zone keeps the wall clock time, same as postgres does when casting '...+00:00' text
+    value = value.replace(tzinfo=None)
+    delta = value - _POSTGRES_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _encode_field(column_type: str, value) -> bytes:
+    if value is None:
+        return _NULL
+    if column_type == "text":
+        data = str(value).encode('utf-8')
+        return struct.pack('>i', len(data)) + data
+    if column_type == "bigint":
+        return _BIGINT.pack(8, int(value))
+    if column_type == "int":
+        return _INT.pack(4, int(value))
+    if column_type == "boolean":
+        return _BOOLEAN[bool(value)]
+    if column_type == "timestamp":
+        micros = _timestamp_micros(value)
+        return _NULL if micros is None else _BIGINT.pack(8, micros)
+    raise ValueError(f"Unsupported column type {column_type}")
+
+
+def table_types(table: str, columns: list[str] | tuple[str, ...] | None = None) -> list[str]:
+    """Column types of `table`, for all columns in schema order or for the given `columns`."""
+    layout = TABLE_LAYOUTS[table]
+    if columns is None:
+        return [column_type for _, column_type in layout]
+    types = dict(layout)
+    return [types[column] for column in columns]
+
+
+def encode_row(types: list[str], row) -> bytes:
+    return struct.pack('>h', len(types)) + b''.join([_encode_field(t, v) for t, v in zip(types, row)])
+
+
+def encode_rows(types: list[str], rows) -> bytes:
+    """Tuples only, without header and trailer, so the output of several calls can be concatenated."""
+    return b''.join([encode_row(types, row) for row in rows])
+
+
+class PgCopyWriter:
+    """Writes a complete binary COPY stream (header, tuples, trailer) into a binary file object."""
+
+    def __init__(self, fileobj, types: list[str]):
+        self.fileobj = fileobj
+        self.types = types
+        self.fileobj.write(PGCOPY_HEADER)
+
+    def write_rows(self, rows):
+        self.fileobj.write(encode_rows(self.types, rows))
+
+    def close(self):
+        self.fileobj.write(PGCOPY_TRAILER)
+
+
+def write_pgcopy_file(path: str, types: list[str], rows):
+    with open(path, 'wb') as f:
+        writer = PgCopyWriter(f, types)
+        writer.write_rows(rows)
+        writer.close()
+
+
+def copy_binary(cursor, table: str, columns: list[str] | tuple[str, ...], rows, types: list[str] | None = None):
+    """Streams `rows` into `table` over the cursor's connection. `types` defaults to the layout of `table`."""
+    buffer = io.BytesIO()
+    writer = PgCopyWriter(buffer, types or table_types(table, columns))
+    writer.write_rows(rows)
+    writer.close()
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT binary)", buffer)
@@ -0,0 +1,185 @@
+import os
+import queue
+import threading
+from time import perf_counter, sleep
+from utils import *
+from hashtag_cache import insert_hashtags
+from metrics import metrics
+
+# Parse/write pipeline for concurrent_uploading. The parse workers only parse and hand every batch to submit(),
+# which puts one slice per table into that table's bounded queue. Every table has a single writer thread with its own
+# connection, so writers never fight over the same rows and parsing goes on while postgres works.
+#
+# Foreign keys still need users/places before tweets and tweets before the link tables. Every submit gets a ticket
+# (an increasing number) and goes into all queues, even with nothing for a table, so a writer only has to wait until
+# the writers it depends on are done with its ticket.
+#
+# A batch that can't be written even after RETRY_LIMIT attempts fails its ticket: the writers after it skip their
+# batches of that ticket and the key it was submitted with ends up in failed_keys, concurrent_uploading doesn't mark
+# that chunk as done. A writer that dies (anything but a failed insert, e.g. a lost connection) would never finish its
+# tickets, so it records its error instead. All writers stop then, submit() and close() raise it.
+
+QUEUE_DEPTH = int(os.getenv("QUEUE_DEPTH", 8))
+RETRY_LIMIT = int(os.getenv("RETRY_LIMIT", 3))
+QUEUE_LOG_INTERVAL = float(os.getenv("QUEUE_LOG_INTERVAL", 10))
+
+# in the order submit() fills the queues, dependencies always come first
+WRITERS = [
+    ("users", insert_users, ()),
+    ("places", insert_places, ()),
+    ("tweets", insert_tweets, ("users", "places")),
+    ("hashtags", insert_hashtags, ("tweets",)),
+    ("urls", insert_urls, ("tweets",)),
+    ("medias", insert_medias, ("tweets",)),
+    ("temp_user_mentions", insert_temp_user_mentions, ()),
+]
+
+_STOP = None
+
+
+class Pipeline:
+    def __init__(self, connect, log, stats=None):
+        self.log = log
+        self.stats = stats
+        self.queues = {name: queue.Queue(maxsize=QUEUE_DEPTH) for name, _, _ in WRITERS}
+        self.max_depth = {name: 0 for name, _, _ in WRITERS}
+        self.wait_seconds = {name: 0.0 for name, _, _ in WRITERS}  # spent waiting on the dependencies
+        self.done = {name: 0 for name, _, _ in WRITERS}  # last ticket every writer finished
+        self.done_condition = threading.Condition()
+        self.submit_lock = threading.Lock()
+        self.ticket = 0
+        self.stopped = threading.Event()
+        self.error: BaseException | None = None  # of the first writer that died
+        self.keys = {}  # ticket -> key it was submitted with
+        self.failed: set[int] = set()  # tickets with a batch that wasn't written
+        self.failed_keys = set()
+        self.threads = [threading.Thread(target=self._write, args=(name, insert_func, dependencies, connect()),
+                                         name=f"writer-{name}", daemon=True)
+                        for name, insert_func, dependencies in WRITERS]
+        self.threads.append(threading.Thread(target=self._log_depths, name="queue-monitor", daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, batches: dict[str, list], key=None):
+        """Hands over one batch per table (keyed by the names in WRITERS), blocks while the queues are full. `key`
+        goes into failed_keys if any of the batches can't be written."""
+        # one ticket at a time, so every queue gets the tickets in increasing order
+        with self.submit_lock:
+            self.ticket += 1
+            if key is not None:
+                self.keys[self.ticket] = key
+            for name, _, _ in WRITERS:
+                self._put(name, (self.ticket, batches.get(name) or []))
+                self.max_depth[name] = max(self.max_depth[name], self.queues[name].qsize())
+
+    def _put(self, name: str, item):
+        # a dead writer doesn't empty its queue any more, don't block on it forever
+        while True:
+            self._raise_error()
+            try:
+                self.queues[name].put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, name: str):
+        # once a writer died, all of them stop
+        while self.error is None:
+            try:
+                return self.queues[name].get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _STOP
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError(f"Pipeline writer failed: {self.error}") from self.error
+
+    def close(self):
+        """Waits for the writers to drain their queues, raises if one of them died."""
+        try:
+            for name, _, _ in WRITERS:
+                self._put(name, _STOP)
+        except RuntimeError:
+            pass  # the writers stop on their own then, raised again below
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.log.info("Max queue depth: " + ", ".join(f"{name}: {depth}/{QUEUE_DEPTH}" for name, depth in self.max_depth.items()))
+        self.log.info("Waited on dependencies: " + ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in self.wait_seconds.items()))
+        self._raise_error()
+
+    def depths(self) -> dict[str, int]:
+        return {name: q.qsize() for name, q in self.queues.items()}
+
+    def _log_depths(self):
+        while not self.stopped.wait(QUEUE_LOG_INTERVAL):
+            depths = self.depths()
+            for name, depth in depths.items():
+                metrics.set("queue_depth", depth, table=name)
+            self.log.info("Queue depths: " + ", ".join(f"{name}: {depth}" for name, depth in depths.items()), False)
+
+    def _wait_for(self, dependencies: tuple[str, ...], ticket: int):
+        time_before = perf_counter()
+        with self.done_condition:
+            self.done_condition.wait_for(lambda: self.error is not None or
+                                         all(self.done[d] >= ticket for d in dependencies))
+        self._raise_error()
+        return perf_counter() - time_before
+
+    def _fail(self, ticket: int):
+        with self.done_condition:
+            self.failed.add(ticket)
+            if ticket in self.keys:
+                self.failed_keys.add(self.keys[ticket])
+
+    def _finish(self, name: str, ticket: int):
+        with self.done_condition:
+            self.done[name] = ticket
+            self.done_condition.notify_all()
+
+    def _write(self, name: str, insert_func, dependencies: tuple[str, ...], conn):
+        cur = conn.cursor()
+        try:
+            while True:
+                item = self._get(name)
+                if item is _STOP:
+                    break
+                ticket, batch = item
+                self.wait_seconds[name] += self._wait_for(dependencies, ticket)
+                # the dependencies are done with the ticket, so a failure of theirs is known by now
+                if batch and ticket not in self.failed and \
+                        not self._insert_with_retries(name, insert_func, cur, conn, batch):
+                    self._fail(ticket)
+                # marked done even if the insert failed, otherwise the dependent writers would wait forever
+                self._finish(name, ticket)
+        except BaseException as e:
+            with self.done_condition:
+                if self.error is None:
+                    self.error = e
+                    self.log.error(f"Writer {name} died: {e}")
+                self.done_condition.notify_all()
+        finally:
+            cur.close()
+            conn.close()
+
+    def _insert_with_retries(self, name: str, insert_func, cur, conn, batch: list) -> bool:
+        for i in range(RETRY_LIMIT):
+            try:
+                time_before = perf_counter()
+                insert_func(cur, batch)
+                conn.commit()
+                if self.stats:
+                    self.stats.add(name, len(batch), perf_counter() - time_before)
+                return True
+            except psycopg2.Error as e:
+                self.log.warning(f"Writing {name} failed, retrying {i + 1}/{RETRY_LIMIT}: {e}", False)
+                metrics.inc("retries_total", table=name)
+                conn.rollback()
+                sleep(1)
+            except Exception as e:  # broken rows, retrying won't help
+                self.log.error(f"Writing {name} failed: {e}")
+                conn.rollback()
+                return False
+        self.log.error(f"Gave up on {len(batch)} {name} rows after {RETRY_LIMIT} attempts")
+        return False
@@ -1,4 +1,19 @@
+import runpy
+import sys
+from time import perf_counter
 from utils import build_schema, cleanup_schema, count_all_tables
+from bulk_schema import split_schema, create_bare_tables, finish_bulk_load
+
+# python rebuild_schema.py                        drops everything and builds sql_scripts/schema.sql
+# python rebuild_schema.py --bulk [loader.py]     drops everything and builds the bare tables only (see bulk_schema),
+#                                                 with a loader script given it also runs it and finishes the schema
+# python rebuild_schema.py --finish               indexes and foreign keys after a --bulk load
+
+args = sys.argv[1:]
+
+if args[:1] == ["--finish"]:
+    finish_bulk_load()
+    sys.exit()
 
 print(count_all_tables())
 with open("history.txt", "a") as f:
@@ -7,4 +22,18 @@ with open("history.txt", "a") as f:
 cleanup_schema()
 with open("log.txt", "w") as f:
     f.write("")
-build_schema()
\ No newline at end of file
+
+if args[:1] == ["--bulk"]:
+    schema = split_schema()
+    time_before = perf_counter()
+    create_bare_tables(schema)
+    print(f"Bare tables created in {perf_counter() - time_before:.2f}s.")
+    if len(args) > 1:
+        time_before = perf_counter()
+        runpy.run_path(args[1], run_name="__main__")
+        print(f"Loaded with {args[1]} in {perf_counter() - time_before:.2f}s.")
+        finish_bulk_load(schema)
+    else:
+        print("Load the data, then run rebuild_schema.py --finish.")
+else:
+    build_schema()
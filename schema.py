@@ -1,6 +1,9 @@
-from pydantic import BaseModel, Field, model_validator
+from pydantic import BaseModel, Field, ValidationInfo, model_validator
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import os
+import re
 
 class IgnoreExtraModel(BaseModel):
     def __str__(self):
@@ -17,7 +20,11 @@ class IgnoreExtraModel(BaseModel):
         return values
 
     @model_validator(mode="before")
-    def clean_nul_bytes(cls, values):
+    def clean_nul_bytes(cls, values, info: ValidationInfo):
+        # the NUL bytes were already stripped from the raw line, no need to rebuild the dict on every nested model
+        if info.context and info.context.get("sanitized"):
+            return values
+
         def clean(val):
             if isinstance(val, str):
                 return val.replace('\x00', '')
@@ -29,6 +36,29 @@ class IgnoreExtraModel(BaseModel):
         return clean(values)
 
 
+# validation context for input that already went through strip_nul_bytes
+SANITIZED = {"sanitized": True}
+
+# in json the NUL byte can only appear as \u0000, escaped backslashes are matched (and kept) on their own, so
+# "\\u0000" (a backslash followed by "u0000") survives
+_NUL_ESCAPE_STR = re.compile(r'(\\\\)|\\u0000')
+_NUL_ESCAPE_BYTES = re.compile(rb'(\\\\)|\\u0000')
+
+
+def strip_nul_bytes(line: str | bytes) -> str | bytes:
+    """Removes NUL bytes from a raw json line, postgres doesn't accept them in TEXT columns.
+
+    Done once per line, the result has to be validated with context=SANITIZED so the models skip clean_nul_bytes.
+    """
+    if isinstance(line, str):
+        if '\x00' in line:
+            line = line.replace('\x00', '')
+        return _NUL_ESCAPE_STR.sub(r'\1', line) if '\\u0000' in line else line
+    if b'\x00' in line:
+        line = line.replace(b'\x00', b'')
+    return _NUL_ESCAPE_BYTES.sub(rb'\1', line) if b'\\u0000' in line else line
+
+
 class User(IgnoreExtraModel):
     id: int
     name: str | None = Field(default='')
@@ -110,7 +140,50 @@ class Tweet(IgnoreExtraModel):
     entities: Entities | None = Field(default=None)
 
 
+TIMESTAMP_CACHE_SIZE = int(os.getenv("TIMESTAMP_CACHE_SIZE", 65536))
+
+_MONTHS = {name: number for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), start=1)}
+_WEEKDAYS = {'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'}
+_TIMEZONES: dict[str, timezone] = {}
+
+
+def _parse_twitter_date(date_str: str) -> str | None:
+    """Parses the fixed twitter layout 'Wed Oct 10 20:19:24 +0000 2018' without strptime.
+
+    Returns None for anything that doesn't have exactly this layout, the caller falls back to strptime then.
+    """
+    if len(date_str) != 30 or date_str[3] != ' ' or date_str[7] != ' ' or date_str[10] != ' ' \
+            or date_str[19] != ' ' or date_str[25] != ' ' or date_str[13] != ':' or date_str[16] != ':':
+        return None
+    month = _MONTHS.get(date_str[4:7])
+    if month is None or date_str[0:3] not in _WEEKDAYS:
+        return None
+    digits = date_str[8:10] + date_str[11:13] + date_str[14:16] + date_str[17:19] + date_str[21:25] + date_str[26:30]
+    if not digits.isdigit() or not digits.isascii() or date_str[20] not in '+-':
+        return None
+
+    offset = date_str[20:25]
+    try:
+        tz = _TIMEZONES.get(offset)
+        if tz is None:
+            minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+            tz = timezone(timedelta(minutes=-minutes if offset[0] == '-' else minutes))
+            _TIMEZONES[offset] = tz
+        dt = datetime(int(date_str[26:30]), month, int(date_str[8:10]),
+                      int(date_str[11:13]), int(date_str[14:16]), int(date_str[17:19]), tzinfo=tz)
+    except ValueError:  # e.g. Feb 30 or an offset of a day and more
+        return None
+    return dt.isoformat()
+
+
+# the same created_at strings come back over and over (every tweet of a user carries the user's created_at)
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
 def to_iso_format(date_str: str) -> str:
+    # Twitter format is by far the most common input, so it's tried first
+    iso = _parse_twitter_date(date_str)
+    if iso is not None:
+        return iso
     # If already in ISO format, return as is
     try:
         # Try parsing as ISO format
@@ -123,4 +196,31 @@ def to_iso_format(date_str: str) -> str:
         dt = datetime.strptime(date_str, '%a %b %d %H:%M:%S %z %Y')
         return dt.isoformat()
     except ValueError: # If can't parse, return original string, cause it's better than nothing
-        return date_str
\ No newline at end of file
+        return date_str
+
+# extended_entities holds the full media list, entities only the first one
+def merge_entities(entities: dict, extended_entities: dict) -> dict:
+    if not extended_entities:
+        return entities or {}
+    if not entities:
+        return extended_entities or {}
+
+    merged = entities.copy()
+    for key, ext_val in extended_entities.items():
+        ent_val = merged.get(key)
+        if isinstance(ext_val, list):
+            # Merge lists, unique by 'id' if present
+            seen_media_ids = set()
+            merged_list = []
+            for item in (ent_val or []) + ext_val:
+                item_id = item.get('id') if isinstance(item, dict) else None
+                if item_id is not None:
+                    if item_id not in seen_media_ids:
+                        seen_media_ids.add(item_id)
+                        merged_list.append(item)
+                else:
+                    merged_list.append(item)
+            merged[key] = merged_list
+        else:
+            merged[key] = ext_val
+    return merged
@@ -0,0 +1,178 @@
+import os
+import pickle
+import zlib
+from contextlib import closing
+from time import time
+from schema import *
+from table_output import *
+from jsonl_reader import *
+from compact_sets import *
+from tweet_decoder import decode_line
+
+# Process based variant of load_into_csv. Threads there are pinned to one core by the GIL, so here the work is split
+# into two phases that both run in a process pool:
+#   map    - every file chunk is parsed on its own, each entity is routed by the hash of its dedup key to the owning shard
+#            and spilled to disk as pickled batches (one spill file per chunk and shard)
+#   reduce - every shard owns its partition of the dedup state (users, tweets, tweet_hashtag, ... sets), reads its
+#            spill files in input order and writes output/shard{n}_{table}.csv (or .pgcopy)
+# load_into_csv then merges the shard files into the same output/{table}.csv files as the threaded mode.
+
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 10000))
+
+
+def shard_of(key: int | str, shard_count: int) -> int:
+    # hash() of str is salted per process, crc32 is stable across workers
+    if isinstance(key, str):
+        return zlib.crc32(key.encode('utf-8')) % shard_count
+    return key % shard_count
+
+
+def spill_path(spill_dir: str, spill_name: str, shard: int) -> str:
+    return os.path.join(spill_dir, f"{spill_name}_{shard}.pkl")
+
+
+def map_file(chunk: Chunk, spill_name: str, shard_count: int, spill_dir: str, max_line: int | None = None):
+    """Parses one chunk and spills the routed entities, returns (line_count, seconds, error)."""
+    routed: list[list[tuple]] = [[] for _ in range(shard_count)]
+    spill_files = [open(spill_path(spill_dir, spill_name, shard), 'wb') for shard in range(shard_count)]
+
+    def route(key, record: tuple):
+        routed[shard_of(key, shard_count)].append(record)
+
+    def route_tweet(_tweet: Tweet):
+        sender = _tweet.user
+        route(sender.id, ("user", sender.id, row_builders.user_row(sender)))
+        if _tweet.place:
+            route(_tweet.place.id, ("place", _tweet.place.id, row_builders.place_row(_tweet.place)))
+        route(_tweet.id, ("tweet", _tweet.id, row_builders.tweet_row(_tweet)))
+
+        if _tweet.entities and _tweet.entities.hashtags:
+            for h in _tweet.entities.hashtags:
+                tag: str = h.text.lower() or ''
+                # the shard owning the tag also owns every (tweet, tag) pair, so it can hand out the hashtag id
+                route(tag, ("tweet_hashtag", _tweet.id, tag))
+        if _tweet.entities and _tweet.entities.urls:
+            for u in _tweet.entities.urls:
+                route(_tweet.id, ("url", (int(_tweet.id), u.url or ''), row_builders.url_row(_tweet.id, u)))
+        if _tweet.entities and _tweet.entities.media:
+            for m in _tweet.entities.media:
+                key = (int(_tweet.id), int(m.id) if m.id is not None else 0)
+                route(_tweet.id, ("media", key, row_builders.media_row(_tweet.id, m)))
+        if _tweet.entities and _tweet.entities.user_mentions:
+            for um in _tweet.entities.user_mentions:
+                route(_tweet.id, ("user_mention", (um.id, _tweet.id), row_builders.user_mention_row(_tweet.id, um)))
+                route(um.id, ("mentioned_user", um.id, row_builders.mentioned_user_row(um)))
+
+        if _tweet.quoted_status:
+            route_tweet(_tweet.quoted_status)
+        if _tweet.retweeted_status:
+            route_tweet(_tweet.retweeted_status)
+
+    def spill():
+        for shard, records in enumerate(routed):
+            if records:
+                pickle.dump(records, spill_files[shard], protocol=pickle.HIGHEST_PROTOCOL)
+                records.clear()
+
+    time_before = time()
+    line_count = 0
+    error = None
+    try:
+        with closing(iter_records(chunk.path, chunk.start, chunk.end)) as file:
+            for line in file:
+                if max_line and line_count >= max_line:
+                    break
+
+                try:
+                    route_tweet(decode_line(line))
+                except Exception as e:
+                    # same as the threaded mode, keep what was parsed so far and stop on the first broken tweet
+                    error = f"Error parsing tweet JSON: {e}"
+                    break
+                line_count += 1
+
+                if line_count % BATCH_SIZE == 0:
+                    spill()
+        spill()
+    finally:
+        for f in spill_files:
+            f.close()
+
+    return line_count, time() - time_before, error
+
+
+def reduce_shard(shard: int, shard_count: int, spill_names: list[str], spill_dir: str, output_dir: str = "output"):
+    """Dedups the partition of one shard and writes its output files. `spill_names` are the chunks in input order.
+
+    Returns (hashtags_map, missing_mentioned_users_set, unique_counts) so the parent can write hashtags.csv and
+    temp_users.csv and report the totals.
+    """
+    users_set: set[int] = new_id_set(f"shard{shard}_users")
+    places_set: set[str] = new_id_set(f"shard{shard}_places")
+    tweets_set: set[int] = new_id_set(f"shard{shard}_tweets")
+    hashtags_map: dict[str, int] = dict()
+    tweet_hashtags_set: set[tuple[int, str]] = new_pair_set(f"shard{shard}_tweet_hashtag")
+    urls_set: set[tuple[int, str]] = new_pair_set(f"shard{shard}_urls")
+    media_set: set[tuple[int, int]] = new_pair_set(f"shard{shard}_media")
+    user_mentions_set: set[tuple[int, int]] = new_pair_set(f"shard{shard}_user_mentions")
+    missing_mentioned_users_set: set[int] = set()
+    # scoped to one export like load_into_csv's registries, every reduce goes through all spill files again and
+    # keys of an earlier run would drop their rows
+    clear_registries([users_set, places_set, tweets_set, tweet_hashtags_set, urls_set, media_set, user_mentions_set])
+
+    shard_writer = ShardWriter(f"shard{shard}", TABLES, output_dir)
+    rows: dict[str, list[list[str]]] = shard_writer.rows
+
+    def add_unique(registry: set, key, table_name: str, row: list[str]):
+        if key not in registry:
+            registry.add(key)
+            rows[table_name].append(row)
+
+    # records are applied in input order, so the result is the same as a single threaded run of load_into_csv
+    for spill_name in spill_names:
+        with open(spill_path(spill_dir, spill_name, shard), 'rb') as spill_file:
+            while True:
+                try:
+                    records = pickle.load(spill_file)
+                except EOFError:
+                    break
+
+                for kind, key, payload in records:
+                    if kind == "user":
+                        missing_mentioned_users_set.discard(key)
+                        add_unique(users_set, key, "users", payload)
+                    elif kind == "mentioned_user":
+                        if key not in users_set:
+                            missing_mentioned_users_set.add(key)
+                            add_unique(users_set, key, "users", payload)
+                    elif kind == "place":
+                        add_unique(places_set, key, "places", payload)
+                    elif kind == "tweet":
+                        add_unique(tweets_set, key, "tweets", payload)
+                    elif kind == "tweet_hashtag":
+                        hashtag_id = hashtags_map.get(payload)
+                        if hashtag_id is None:
+                            # ids are interleaved between shards so they stay unique without coordination
+                            hashtag_id = shard + 1 + len(hashtags_map) * shard_count
+                            hashtags_map[payload] = hashtag_id
+                        add_unique(tweet_hashtags_set, (key, payload), "tweet_hashtag", row_builders.tweet_hashtag_row(key, hashtag_id))
+                    elif kind == "url":
+                        add_unique(urls_set, key, "urls", payload)
+                    elif kind == "media":
+                        add_unique(media_set, key, "media", payload)
+                    elif kind == "user_mention":
+                        add_unique(user_mentions_set, key, "user_mentions", payload)
+
+                shard_writer.flush_if_full()
+    shard_writer.close()
+
+    unique_counts = {
+        "users": len(users_set),
+        "places": len(places_set),
+        "tweets": len(tweets_set),
+        "urls": len(urls_set),
+        "media": len(media_set),
+        "user_mentions": len(user_mentions_set),
+    }
+    close_registries([users_set, places_set, tweets_set, tweet_hashtags_set, urls_set, media_set, user_mentions_set])
+    return hashtags_map, missing_mentioned_users_set, unique_counts
@@ -0,0 +1,14 @@
+-- files written by load_into_csv with OUTPUT_FORMAT=pgcopy
+-- "users", "places", "tweets", "hashtags", "urls", "media", "user_mentions"]
+COPY users FROM 'C:\Users\marti\PycharmProjects\PDT\output\users.pgcopy' WITH (FORMAT binary);
+COPY temp_users FROM 'C:\Users\marti\PycharmProjects\PDT\output\temp_users.pgcopy' WITH (FORMAT binary);
+COPY places FROM 'C:\Users\marti\PycharmProjects\PDT\output\places.pgcopy' WITH (FORMAT binary);
+COPY tweets FROM 'C:\Users\marti\PycharmProjects\PDT\output\tweets.pgcopy' WITH (FORMAT binary);
+COPY hashtags FROM 'C:\Users\marti\PycharmProjects\PDT\output\hashtags.pgcopy' WITH (FORMAT binary);
+COPY tweet_hashtag FROM 'C:\Users\marti\PycharmProjects\PDT\output\tweet_hashtag.pgcopy' WITH (FORMAT binary);
+COPY tweet_urls FROM 'C:\Users\marti\PycharmProjects\PDT\output\urls.pgcopy' WITH (FORMAT binary);
+COPY tweet_user_mentions FROM 'C:\Users\marti\PycharmProjects\PDT\output\user_mentions.pgcopy' WITH (FORMAT binary);
+COPY tweet_media FROM 'C:\Users\marti\PycharmProjects\PDT\output\media.pgcopy' WITH (FORMAT binary);
+
+-- Remove temporary non-existent users
+DELETE FROM users WHERE id IN (SELECT id FROM temp_users);
\ No newline at end of file
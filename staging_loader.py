@@ -0,0 +1,67 @@
+import threading
+from time import perf_counter
+from copy_loader import *
+
+# Append only variant of copy_loader. Every worker COPYs its batches into its own UNLOGGED staging tables, which no
+# other session touches, so the workers never wait on each other's row locks and can't deadlock. Once all workers
+# are done, merge_stages moves everything into the real tables with one INSERT ... SELECT ... ON CONFLICT per table,
+# in foreign key order (users and places before tweets before the link tables).
+
+_worker_ids = threading.local()
+_worker_count = 0
+_worker_lock = threading.Lock()
+
+
+def worker_id() -> int:
+    """Small stable id of the calling thread, used to pick its staging tables."""
+    global _worker_count
+    if not hasattr(_worker_ids, "id"):
+        with _worker_lock:
+            _worker_ids.id = _worker_count
+            _worker_count += 1
+    return _worker_ids.id
+
+
+def worker_stage_name(table: CopyTable, worker: int) -> str:
+    return f"stage_{table.target}_{worker}"
+
+
+def create_worker_stages(cursor, worker_count: int):
+    # UNLOGGED skips the WAL, the staged rows are thrown away after the merge anyway
+    cursor.execute("\n".join(f"DROP TABLE IF EXISTS {worker_stage_name(table, worker)}; "
+                             f"CREATE UNLOGGED TABLE {worker_stage_name(table, worker)} {stage_columns(table)};"
+                             for table in COPY_TABLES for worker in range(worker_count)))
+
+
+def drop_worker_stages(cursor, worker_count: int):
+    cursor.execute("\n".join(f"DROP TABLE IF EXISTS {worker_stage_name(table, worker)};"
+                             for table in COPY_TABLES for worker in range(worker_count)))
+
+
+def stage_batches(cursor, worker: int, batches: dict[str, list], stats: LoadStats | None = None):
+    """Appends all batches (keyed by CopyTable.name) to the staging tables of `worker`, the caller commits."""
+    timings = []
+    for table in COPY_TABLES:
+        batch = batches.get(table.name)
+        if not batch:
+            continue
+        time_before = perf_counter()
+        copy_rows(cursor, table, worker_stage_name(table, worker), batch_rows(table, batch))
+        timings.append((table.name, len(batch), perf_counter() - time_before))
+    if stats:
+        for name, rows, seconds in timings:
+            stats.add(name, rows, seconds)
+
+
+def merge_stages(cursor, worker_count: int, stats: LoadStats | None = None):
+    """Merges the staging tables of all workers into the target tables, runs in a single session."""
+    for table in COPY_TABLES:
+        columns = ", ".join(table.columns)
+        view = f"staged_{table.target}"
+        cursor.execute(f"CREATE OR REPLACE TEMP VIEW {view} AS " + " UNION ALL ".join(
+            f"SELECT {columns} FROM {worker_stage_name(table, worker)}" for worker in range(worker_count)))
+        time_before = perf_counter()
+        cursor.execute(merge_query(table, view))
+        if stats:
+            stats.add(f"merge {table.name}", cursor.rowcount, perf_counter() - time_before)
+        cursor.execute(f"DROP VIEW {view}")
@@ -0,0 +1,184 @@
+import csv
+import os
+import shutil
+from time import perf_counter
+import csv_rows
+import typed_rows
+from pgcopy import *
+from metrics import metrics
+from parquet_output import ParquetShardWriter, write_parquet_file, merge_parquet_files, require_pyarrow
+
+# Output format of load_into_csv and sharded_export:
+#   "csv"    - the csv files copy_from_csv.sql loads
+#   "pgcopy"  - binary COPY files (see pgcopy), loaded with COPY ... FROM '...' WITH (FORMAT binary)
+#   "parquet" - typed, compressed parquet files for analytics (see parquet_output), needs pyarrow
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "csv")
+EXTENSION = OUTPUT_FORMAT if OUTPUT_FORMAT in ("pgcopy", "parquet") else "csv"
+# What happens with the per chunk shard files at the end:
+#   "merge"    - concatenated into one file per table, the bytes are copied by the kernel (copy_file_range/sendfile)
+#   "manifest" - left as they are, COPY_MANIFEST lists a COPY statement for every shard instead (csv only, binary
+#                shards would need their own header and trailer)
+MERGE_MODE = os.getenv("MERGE_MODE", "merge")
+# ShardWriter writes its buffered rows out after this many rows or this much (estimated) output, whichever comes first
+FLUSH_ROWS = int(os.getenv("FLUSH_ROWS", 10000))
+MAX_BUFFER_BYTES = int(float(os.getenv("MAX_BUFFER_MB", 16)) * 1024 * 1024)
+COPY_MANIFEST = os.getenv("COPY_MANIFEST", "copy_manifest.sql")
+if MERGE_MODE == "manifest" and OUTPUT_FORMAT != "csv":
+    raise ValueError("MERGE_MODE=manifest only works with OUTPUT_FORMAT=csv")
+if OUTPUT_FORMAT == "parquet":
+    require_pyarrow()
+
+# row builders matching the output format, both modules have the same functions
+row_builders = typed_rows if OUTPUT_FORMAT in ("pgcopy", "parquet") else csv_rows
+
+TABLES = csv_rows.TABLES
+
+# output file name -> table in sql_scripts/schema.sql
+SQL_TABLES = {
+    "users": "users",
+    "places": "places",
+    "tweets": "tweets",
+    "tweet_hashtag": "tweet_hashtag",
+    "urls": "tweet_urls",
+    "media": "tweet_media",
+    "user_mentions": "tweet_user_mentions",
+    "hashtags": "hashtags",
+    "temp_users": "temp_users",
+}
+
+# order of the COPY statements, referenced tables first (same as sql_scripts/copy_from_csv.sql)
+COPY_ORDER = ["users", "temp_users", "places", "tweets", "hashtags", "tweet_hashtag", "urls", "user_mentions", "media"]
+
+
+def output_path(name: str, output_dir: str = "output") -> str:
+    return os.path.join(output_dir, f"{name}.{EXTENSION}")
+
+
+def _estimate_row_bytes(row) -> int:
+    return sum(len(value) if isinstance(value, (str, bytes)) else 8 for value in row) + len(row)
+
+
+class ShardWriter:
+    """Buffered rows and open append handles for the shard files of one chunk, one file per table.
+
+    Callers fill `rows[table]` and call flush_if_full() now and then, the files stay open until close(). Binary shards
+    only hold tuples, merge_shards adds header and trailer.
+    """
+
+    def __init__(self, shard_name: str, tables: list[str], output_dir: str = "output"):
+        self.paths = {table: output_path(f"{shard_name}_{table}", output_dir) for table in tables}
+        self.rows: dict[str, list] = {table: [] for table in tables}
+        self.row_bytes = {table: 256 for table in tables}  # refreshed from a sample row on every flush
+        self._files = {}
+        self._writers = {}
+
+    def _writer(self, table: str):
+        if table not in self._writers:
+            if OUTPUT_FORMAT == "parquet":
+                # a new file per writer, every flush is a row group
+                f = ParquetShardWriter(self.paths[table], SQL_TABLES[table])
+                self._writers[table] = f.write_rows
+            elif OUTPUT_FORMAT == "pgcopy":
+                f = open(self.paths[table], 'ab')
+                types = table_types(SQL_TABLES[table])
+                self._writers[table] = lambda table_rows: f.write(encode_rows(types, table_rows))
+            else:
+                f = open(self.paths[table], 'a', newline='', encoding='utf-8', buffering=1024 * 1024)
+                self._writers[table] = csv.writer(f).writerows
+            self._files[table] = f
+        return self._writers[table]
+
+    def buffered_bytes(self) -> int:
+        return sum(len(table_rows) * self.row_bytes[table] for table, table_rows in self.rows.items())
+
+    def flush_if_full(self):
+        if sum(len(table_rows) for table_rows in self.rows.values()) >= FLUSH_ROWS \
+                or self.buffered_bytes() >= MAX_BUFFER_BYTES:
+            self.flush()
+
+    def flush(self):
+        if not any(self.rows.values()):
+            return
+        time_before = perf_counter()
+        for table, table_rows in self.rows.items():
+            if table_rows:
+                self.row_bytes[table] = _estimate_row_bytes(table_rows[-1])
+                self._writer(table)(table_rows)
+                table_rows.clear()
+        metrics.observe("shard_flush_seconds", perf_counter() - time_before)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+            self._writers.clear()
+
+
+def write_table(path: str, table: str, table_rows):
+    """Writes a complete output file in one go (hashtags, temp_users)."""
+    if OUTPUT_FORMAT == "parquet":
+        write_parquet_file(path, SQL_TABLES[table], table_rows)
+    elif OUTPUT_FORMAT == "pgcopy":
+        write_pgcopy_file(path, table_types(SQL_TABLES[table]), table_rows)
+    else:
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerows(table_rows)
+
+
+def _copy_file(infile, outfile):
+    """Appends infile to outfile without pulling the data through python, falls back to a buffered copy."""
+    size = os.fstat(infile.fileno()).st_size
+    offset = 0
+    for kernel_copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+        if kernel_copy is None:
+            continue
+        try:
+            while offset < size:
+                if kernel_copy is os.sendfile:
+                    copied = os.sendfile(outfile.fileno(), infile.fileno(), offset, size - offset)
+                else:
+                    copied = os.copy_file_range(infile.fileno(), outfile.fileno(), size - offset, offset)
+                if not copied:
+                    break
+                offset += copied
+            return
+        except OSError:  # e.g. EXDEV on older kernels, the next one continues at `offset`
+            pass
+    infile.seek(offset)
+    shutil.copyfileobj(infile, outfile, 1024 * 1024)
+    # the next shard may go through the kernel again, straight to the fd and ahead of anything still buffered here
+    outfile.flush()
+
+
+def merge_shards(path: str, table: str, shard_paths: list[str]):
+    """Concatenates the shard files of `table` into `path` and removes them."""
+    if OUTPUT_FORMAT == "parquet":
+        # parquet files can't be concatenated, their row groups are copied into the new file instead
+        merge_parquet_files(path, SQL_TABLES[table], shard_paths)
+        return
+    with open(path, 'wb') as outfile:
+        if OUTPUT_FORMAT == "pgcopy":
+            outfile.write(PGCOPY_HEADER)
+            outfile.flush()  # the kernel copies go around the python buffer
+        for shard_path in shard_paths:
+            if os.path.exists(shard_path):
+                with open(shard_path, 'rb') as infile:
+                    _copy_file(infile, outfile)
+                os.remove(shard_path)  # remove the individual file after merging
+        if OUTPUT_FORMAT == "pgcopy":
+            outfile.write(PGCOPY_TRAILER)
+
+
+def write_copy_manifest(path: str, table_files: dict[str, list[str]]):
+    """Writes a COPY statement for every existing file, `table_files` maps output names to their files."""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("-- written by load_into_csv with MERGE_MODE=manifest, one COPY per shard\n")
+        for table in COPY_ORDER:
+            for file_path in table_files.get(table, []):
+                if os.path.exists(file_path):
+                    f.write(f"COPY {SQL_TABLES[table]} FROM '{os.path.abspath(file_path)}' DELIMITER ',' CSV;\n")
+        f.write("\n-- Remove temporary non-existent users\nDELETE FROM users WHERE id IN (SELECT id FROM temp_users);\n")
@@ -0,0 +1,68 @@
+import threading
+from metrics import metrics
+from schema import *
+
+# The per table batches concurrent_uploading fills while parsing, named like the tables (and copy_loader's
+# COPY_TABLES) they are written to. benchmarks.bench_stages times the same code.
+
+
+class SeenTweets:
+    """Tweets this run already put into a batch, and the ones whose batch is committed (`committed`, the disk backend
+    keeps those for later runs). Only committed ids are persisted, a crash before the commit doesn't skip the tweets
+    on the rerun."""
+
+    def __init__(self, committed):
+        self.committed = committed
+        self.pending: set[int] = set()
+        self._lock = threading.Lock()
+
+    def claim(self, tweet_id: int) -> bool:
+        """False if the tweet was seen before."""
+        with self._lock:
+            if tweet_id in self.pending or tweet_id in self.committed:
+                return False
+            self.pending.add(tweet_id)
+            return True
+
+    def commit(self, tweet_ids: list[int]):
+        """The batches with these tweets are in the database."""
+        with self._lock:
+            for tweet_id in tweet_ids:
+                self.committed.add(tweet_id)
+                self.pending.discard(tweet_id)
+
+
+def new_batches() -> dict[str, list]:
+    return {"users": [], "places": [], "tweets": [], "hashtags": [], "urls": [], "medias": [],
+            "temp_user_mentions": []}
+
+
+def add_tweet(batches: dict[str, list], _tweet: Tweet, seen: SeenTweets):
+    """Adds the tweet and its nested tweets to the batches, tweets seen before are skipped."""
+    if not seen.claim(_tweet.id):
+        metrics.inc("dedup_hits_total", table="tweets")
+        return
+
+    if _tweet.user:
+        batches["users"].append(_tweet.user)
+    if _tweet.place:
+        batches["places"].append(_tweet.place)
+    batches["tweets"].append(_tweet)
+    if _tweet.entities:
+        if _tweet.entities.hashtags:
+            for hashtag in _tweet.entities.hashtags:
+                batches["hashtags"].append((_tweet.id, hashtag))
+        if _tweet.entities.urls:
+            for url in _tweet.entities.urls:
+                batches["urls"].append((_tweet.id, url))
+        if _tweet.entities.media:
+            for media in _tweet.entities.media:
+                batches["medias"].append((_tweet.id, media))
+        if _tweet.entities.user_mentions:
+            for user_mention in _tweet.entities.user_mentions:
+                batches["temp_user_mentions"].append((_tweet.id, user_mention))
+
+    if _tweet.quoted_status:
+        add_tweet(batches, _tweet.quoted_status, seen)
+    if _tweet.retweeted_status:
+        add_tweet(batches, _tweet.retweeted_status, seen)
@@ -0,0 +1,61 @@
+import json
+import os
+from schema import *
+
+# "pydantic" decodes every line with json.loads and runs it through Tweet.model_validate, "fast" hands the raw line
+# straight to pydantic-core with model_validate_json. Both strip the NUL bytes from the raw line first, so
+# clean_nul_bytes doesn't have to rebuild the dict on every nested model.
+DECODER = os.getenv("DECODER", "pydantic")
+
+
+def validate_line(line: str | bytes) -> Tweet:
+    tweet_json = json.loads(strip_nul_bytes(line))
+    if 'extended_entities' in tweet_json:
+        tweet_json['entities'] = merge_entities(tweet_json.get('entities', {}), tweet_json['extended_entities'])
+    return Tweet.model_validate(tweet_json, context=SANITIZED)
+
+
+class _FastTweet(Tweet):
+    # parsed only on the top level tweet, nested ones are plain Tweets that ignore it, same as merge_entities is only
+    # applied on the top level in validate_line
+    extended_entities: Entities | None = Field(default=None)
+
+
+def _merge_extended_entities(tweet: _FastTweet):
+    """merge_entities, but on the validated models."""
+    if 'extended_entities' not in tweet.model_fields_set:
+        return
+    extended = tweet.extended_entities
+    if extended is None or not extended.model_fields_set:
+        if tweet.entities is None:
+            tweet.entities = Entities()
+        return
+    if tweet.entities is None or not tweet.entities.model_fields_set:
+        tweet.entities = extended
+        return
+
+    for key in extended.model_fields_set:
+        ext_val = getattr(extended, key)
+        if isinstance(ext_val, list):
+            seen_ids = set()
+            merged_list = []
+            for item in (getattr(tweet.entities, key) or []) + ext_val:
+                item_id = getattr(item, 'id', None)
+                if item_id is not None:
+                    if item_id not in seen_ids:
+                        seen_ids.add(item_id)
+                        merged_list.append(item)
+                else:
+                    merged_list.append(item)
+            setattr(tweet.entities, key, merged_list)
+        else:
+            setattr(tweet.entities, key, ext_val)
+
+
+def fast_decode_line(line: str | bytes) -> Tweet:
+    tweet = _FastTweet.model_validate_json(strip_nul_bytes(line), context=SANITIZED)
+    _merge_extended_entities(tweet)
+    return tweet
+
+
+decode_line = fast_decode_line if DECODER == "fast" else validate_line
@@ -0,0 +1,49 @@
+from schema import *
+
+# Same rows as csv_rows, in the column order of sql_scripts/schema.sql, but as python values instead of pre-quoted
+# strings. Used by the binary (pgcopy) and parquet output, which need typed values and have no quoting to work around,
+# so the description and full_text columns are filled in as well.
+
+
+def user_row(user: User) -> tuple:
+    return (user.id, user.screen_name, user.name, user.description, user.verified, user.protected,
+            user.followers_count, user.friends_count, user.statuses_count,
+            to_iso_format(user.created_at) if user.created_at else None, user.location, user.url)
+
+
+# users that are only known from a mention, we don't have anything but id and names
+def mentioned_user_row(user_mention: UserMention) -> tuple:
+    return (user_mention.id, user_mention.screen_name, user_mention.name, None, None, None, 0, 0, 0,
+            None, None, None)
+
+
+def place_row(place: Place) -> tuple:
+    return place.id, place.full_name, place.country, place.country_code, place.place_type
+
+
+def tweet_row(tweet: Tweet) -> tuple:
+    display_from, display_to = tweet.display_text_range or (None, None)
+    return (tweet.id, to_iso_format(tweet.created_at) if tweet.created_at else None, tweet.full_text,
+            display_from, display_to, tweet.lang, tweet.user.id if tweet.user else None, tweet.source,
+            tweet.in_reply_to_status_id, tweet.quoted_status_id,
+            tweet.retweeted_status.id if tweet.retweeted_status is not None else None,
+            tweet.place.id if tweet.place else None,
+            tweet.retweet_count, tweet.favorite_count, tweet.possibly_sensitive)
+
+
+def tweet_hashtag_row(tweet_id: int, hashtag_id: int) -> tuple:
+    return tweet_id, hashtag_id
+
+
+def url_row(tweet_id: int, url: Url) -> tuple:
+    return (tweet_id, url.url, url.expanded_url, url.display_url,
+            url.unwound_url.url if url.unwound_url else None)
+
+
+def media_row(tweet_id: int, media: Media) -> tuple:
+    return (tweet_id, media.id, media.type, media.media_url, media.media_url_https, media.display_url,
+            media.expanded_url)
+
+
+def user_mention_row(tweet_id: int, user_mention: UserMention) -> tuple:
+    return tweet_id, user_mention.id, user_mention.screen_name, user_mention.name
@@ -69,6 +69,7 @@ def cleanup_schema(connection = None):
     DROP TABLE IF EXISTS tweet_media CASCADE;
     DROP TABLE IF EXISTS tweet_user_mentions CASCADE;
     DROP TABLE IF EXISTS temp_tweet_user_mentions CASCADE;
+    DROP TABLE IF EXISTS temp_users CASCADE;
     """
 
     try: